@@ -0,0 +1,35 @@
+from __future__ import print_function
+
+import argparse
+import json
+
+
+def load(path):
+  with open(path) as f:
+    return {result['name']: result for result in json.load(f)['results']}
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare two hot_paths.py reports')
+  parser.add_argument('baseline')
+  parser.add_argument('candidate')
+  parser.add_argument('--threshold', type=float, default=1.1, help='slowdown ratio reported as a regression')
+  args = parser.parse_args()
+
+  baseline = load(args.baseline)
+  candidate = load(args.candidate)
+  regressions = 0
+  for name in sorted(set(baseline) & set(candidate)):
+    before = baseline[name]['seconds_per_item']
+    after = candidate[name]['seconds_per_item']
+    ratio = after / before
+    marker = ''
+    if ratio > args.threshold:
+      marker = '  REGRESSION'
+      regressions += 1
+    print('{0:40} {1:12.3f}us {2:12.3f}us {3:8.2f}x{4}'.format(name, before * 1e6, after * 1e6, ratio, marker))
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  raise SystemExit(main())
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import random
+import sys
+import timeit
+
+from ttbot import TelegramBot, _convert_utf8, _convert_markup
+from ttbot.types import Message, CallbackQuery, InlineQuery, InlineKeyboardMarkup, InlineKeyboardButton
+
+
+def _user(user_id):
+  return {'id': user_id, 'first_name': u'User %d' % user_id, 'username': u'user%d' % user_id,
+          'language_code': u'en'}
+
+
+def _private_chat(user_id):
+  chat = _user(user_id)
+  chat['type'] = u'private'
+  return chat
+
+
+def text_message(message_id, user_id, text):
+  return {'message_id': message_id, 'from': _user(user_id), 'chat': _private_chat(user_id), 'date': 1500000000,
+          'text': text}
+
+
+def photo_message(message_id, user_id):
+  return {'message_id': message_id, 'from': _user(user_id), 'chat': _private_chat(user_id), 'date': 1500000000,
+          'caption': u'photo caption',
+          'photo': [{'file_id': u'AgADBAAD%d' % i, 'width': 90 * i, 'height': 60 * i, 'file_size': 1000 * i}
+                    for i in range(1, 5)]}
+
+
+def reply_chain(message_id, user_id, depth):
+  message = text_message(message_id, user_id, u'reply 0')
+  for i in range(1, depth + 1):
+    reply = text_message(message_id + i, user_id, u'reply %d' % i)
+    reply['reply_to_message'] = message
+    message = reply
+  return message
+
+
+def callback_query(query_id, user_id):
+  return {'id': str(query_id), 'from': _user(user_id), 'data': u'action:%d' % query_id,
+          'message': text_message(query_id, user_id, u'pick one')}
+
+
+def inline_query(query_id, user_id):
+  return {'id': str(query_id), 'from': _user(user_id), 'query': u'search %d' % query_id, 'offset': u''}
+
+
+def updates_corpus(size, chats, seed=0):
+  rnd = random.Random(seed)
+  updates = []
+  for update_id in range(size):
+    user_id = rnd.randint(1, chats)
+    kind = rnd.random()
+    if kind < 0.6:
+      update = {'message': text_message(update_id, user_id, rnd.choice([u'/start', u'/help arg', u'hello there']))}
+    elif kind < 0.75:
+      update = {'message': photo_message(update_id, user_id)}
+    elif kind < 0.85:
+      update = {'message': reply_chain(update_id, user_id, 3)}
+    elif kind < 0.95:
+      update = {'callback_query': callback_query(update_id, user_id)}
+    else:
+      update = {'inline_query': inline_query(update_id, user_id)}
+    update['update_id'] = update_id
+    updates.append(update)
+  return updates
+
+
+def _bot_with_handlers(count):
+  bot = TelegramBot('111:ff', 'benchmark')
+  for i in range(count):
+    kind = i % 3
+    if kind == 0:
+      bot.register_message_handler(lambda m, b: None, commands=['command%d' % i])
+    elif kind == 1:
+      bot.register_message_handler(lambda m, b: None, regexp='^pattern%d' % i)
+    else:
+      bot.register_message_handler(lambda m, b: None, func=lambda m, i=i: m.text == 'text%d' % i)
+  bot.register_message_handler(lambda m, b: None, commands=['start', 'help'])
+  return bot
+
+
+def benchmarks(handlers):
+  corpus = updates_corpus(1000, 50)
+  messages = [update['message'] for update in corpus if 'message' in update]
+  text = [m for m in messages if 'text' in m and 'reply_to_message' not in m]
+  photos = [m for m in messages if 'photo' in m]
+  replies = [m for m in messages if 'reply_to_message' in m]
+  callbacks = [update['callback_query'] for update in corpus if 'callback_query' in update]
+  inline_queries = [update['inline_query'] for update in corpus if 'inline_query' in update]
+  parsed = [Message.de_json(m) for m in text]
+
+  bot = _bot_with_handlers(handlers)
+  grouping_bot = TelegramBot('111:ff', 'benchmark')
+  grouping_bot.process_message = lambda message: None
+  parsed_messages = [Message.de_json(m) for m in messages]
+
+  markup = InlineKeyboardMarkup([[InlineKeyboardButton(u'button %d' % (row * 3 + col), callback_data=u'data:%d' % col)
+                                  for col in range(3)] for row in range(4)])
+  markup_dict = markup.to_json_dict()
+  payload = {'chat_id': '123456789', 'text': u'привет world', 'parse_mode': 'markdown',
+             'reply_markup': markup.to_json()}
+
+  return [
+    ('message_de_json_text', len(text), lambda: [Message.de_json(m) for m in text]),
+    ('message_de_json_photo', len(photos), lambda: [Message.de_json(m) for m in photos]),
+    ('message_de_json_reply_chain', len(replies), lambda: [Message.de_json(m) for m in replies]),
+    ('callback_query_de_json', len(callbacks), lambda: [CallbackQuery.de_json(c) for c in callbacks]),
+    ('inline_query_de_json', len(inline_queries), lambda: [InlineQuery.de_json(q) for q in inline_queries]),
+    ('convert_utf8_payload', 1, lambda: _convert_utf8(payload)),
+    ('find_command_handler_%d' % handlers, len(parsed),
+     lambda: [bot._find_command_handler_function(m) for m in parsed]),
+    ('test_message_handler_linear_%d' % handlers, len(parsed),
+     lambda: [next((h for h in bot.message_handlers if bot._test_message_handler(h, m)), None) for m in parsed]),
+    ('process_messages_grouping', len(parsed_messages), lambda: grouping_bot.process_messages(parsed_messages)),
+    ('markup_to_json', 1, lambda: markup.to_json()),
+    ('markup_dict_convert', 1, lambda: _convert_markup(markup_dict)),
+  ]
+
+
+def run(names=None, handlers=100, repeat=5, min_time=0.2):
+  results = []
+  for name, items, fn in benchmarks(handlers):
+    if names and name not in names:
+      continue
+    timer = timeit.Timer(fn)
+    number = 1
+    while timer.timeit(number) < min_time:
+      number *= 2
+    best = min(timer.repeat(repeat, number)) / number
+    results.append({'name': name, 'items': items, 'seconds_per_call': best, 'seconds_per_item': best / items})
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Microbenchmarks for the ttbot parse and dispatch hot paths')
+  parser.add_argument('names', nargs='*', help='benchmarks to run, all by default')
+  parser.add_argument('--handlers', type=int, default=100, help='registered message handlers')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+  args = parser.parse_args()
+
+  report = {
+    'python': platform.python_version(),
+    'implementation': platform.python_implementation(),
+    'results': run(args.names, args.handlers, args.repeat),
+  }
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  else:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,82 @@
+from __future__ import print_function
+
+import json
+import sys
+
+from ttbot.types import Message, LazyMessage
+
+TEXT_MESSAGE = {
+  'message_id': 1000,
+  'from': {'id': 123456789, 'first_name': 'John', 'last_name': 'Doe', 'username': 'johndoe', 'language_code': 'en'},
+  'chat': {'id': 123456789, 'first_name': 'John', 'last_name': 'Doe', 'username': 'johndoe', 'type': 'private'},
+  'date': 1500000000,
+  'text': 'hello world',
+}
+
+PHOTO_REPLY_MESSAGE = {
+  'message_id': 1001,
+  'from': {'id': 123456789, 'first_name': 'John'},
+  'chat': {'id': -100123, 'title': 'group', 'type': 'supergroup'},
+  'date': 1500000000,
+  'caption': 'look',
+  'photo': [{'file_id': 'AgADBAAD%d' % i, 'width': 90 * i, 'height': 60 * i, 'file_size': 1000 * i}
+            for i in range(1, 4)],
+  'reply_to_message': TEXT_MESSAGE,
+}
+
+
+def deep_size(obj, seen=None):
+  if seen is None:
+    seen = set()
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+  size = sys.getsizeof(obj)
+  if isinstance(obj, dict):
+    size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+  elif isinstance(obj, (list, tuple)):
+    size += sum(deep_size(item, seen) for item in obj)
+  elif not isinstance(obj, (str, bytes, int, float, type(None), type(u''))):
+    if hasattr(obj, '__dict__'):
+      size += deep_size(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+      for slot in cls.__dict__.get('__slots__', ()):
+        if hasattr(obj, slot):
+          size += deep_size(getattr(obj, slot), seen)
+  return size
+
+
+def _leaves(obj, ids):
+  if isinstance(obj, dict):
+    for k, v in obj.items():
+      ids.add(id(k))
+      _leaves(v, ids)
+  elif isinstance(obj, list):
+    for item in obj:
+      _leaves(item, ids)
+  else:
+    ids.add(id(obj))
+  return ids
+
+
+def bytes_per_message(message_class, obj, touch=()):
+  # strings and numbers are shared with the decoded update, only containers and objects are counted
+  shared = _leaves(obj, set())
+  message = message_class.de_json(obj)
+  for name in touch:
+    getattr(message, name)
+  return deep_size(message, shared)
+
+
+def main():
+  results = {
+    'message_text': bytes_per_message(Message, TEXT_MESSAGE),
+    'message_photo_reply': bytes_per_message(Message, PHOTO_REPLY_MESSAGE),
+    'lazy_message_text': bytes_per_message(LazyMessage, TEXT_MESSAGE, ('chat', 'text')),
+  }
+  json.dump(results, sys.stdout, indent=2, sort_keys=True)
+  print()
+
+
+if __name__ == '__main__':
+  main()
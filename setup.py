@@ -19,6 +19,10 @@ setup(
     'twisted',
     'treq',
   ],
+  extras_require={
+    'ujson': ['ujson'],
+    'orjson': ['orjson'],
+  },
   tests_require=[
     'mock'
   ]
@@ -0,0 +1,97 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import MagicMock
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+
+from ttbot import TelegramBot, ApiException
+from ttbot.broadcast import Broadcast
+
+
+class TestBroadcast(TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.checkpoint_path = os.path.join(self.directory, 'broadcast.json')
+    self.bot = TelegramBot("111:ff", "botname")
+    self.bot.clock = Clock()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_counts_blocked_chats_and_resumes_from_checkpoint(self):
+    sent = []
+
+    def send(chat_id):
+      if chat_id == 3:
+        return fail(ApiException('Forbidden', 'sendMessage', None, error_code=403))
+      sent.append(chat_id)
+      return succeed(None)
+
+    results = []
+    Broadcast(self.bot, iter(range(1, 6)), send, checkpoint_path=self.checkpoint_path,
+              concurrency=2).run().addCallback(results.append)
+    self.bot.clock.pump([0.1] * 10)
+
+    stats = results[0]
+    self.assertEqual(sorted(sent), [1, 2, 4, 5])
+    self.assertEqual((stats.sent, stats.blocked, stats.failed, stats.position), (4, 1, 0, 5))
+    with open(self.checkpoint_path) as f:
+      self.assertEqual(json.load(f)['position'], 5)
+
+    with open(self.checkpoint_path, 'w') as f:
+      json.dump({'position': 3, 'sent': 2, 'blocked': 1, 'failed': 0}, f)
+    del sent[:]
+    Broadcast(self.bot, iter(range(1, 6)), send, checkpoint_path=self.checkpoint_path).run()
+    self.bot.clock.pump([0.1] * 10)
+    self.assertEqual(sorted(sent), [4, 5])
+
+  def test_checkpoint_only_counts_chats_before_its_position(self):
+    stuck = Deferred()
+    send = MagicMock(side_effect=lambda chat_id: stuck if chat_id == 1 else succeed(None))
+    Broadcast(self.bot, [1, 2], send, checkpoint_path=self.checkpoint_path, concurrency=2,
+              checkpoint_every=1).run()
+    self.bot.clock.pump([0.1] * 10)
+    with open(self.checkpoint_path) as f:
+      self.assertEqual(json.load(f), {'position': 0, 'sent': 0, 'blocked': 0, 'failed': 0})
+
+    # the process died with chat 1 in flight, both chats are sent again
+    results = []
+    Broadcast(self.bot, [1, 2], lambda chat_id: succeed(None),
+              checkpoint_path=self.checkpoint_path).run().addCallback(results.append)
+    self.bot.clock.pump([0.1] * 10)
+    self.assertEqual((results[0].sent, results[0].position), (2, 2))
+    with open(self.checkpoint_path) as f:
+      self.assertEqual(json.load(f)['sent'], 2)
+
+  def test_failing_chat_ids_fail_the_broadcast(self):
+    def chat_ids():
+      yield 1
+      yield 2
+      raise IOError('lost the database')
+
+    send = MagicMock(side_effect=lambda chat_id: succeed(None))
+    errback = MagicMock()
+    Broadcast(self.bot, chat_ids(), send, checkpoint_path=self.checkpoint_path,
+              concurrency=3).run().addErrback(errback)
+    self.bot.clock.pump([0.1] * 10)
+
+    self.assertTrue(errback.call_args[0][0].check(IOError))
+    self.assertEqual(send.call_count, 2)
+    with open(self.checkpoint_path) as f:
+      self.assertEqual(json.load(f), {'position': 2, 'sent': 2, 'blocked': 0, 'failed': 0})
+
+  def test_waits_retry_after(self):
+    send = MagicMock(side_effect=[
+      fail(ApiException('Too Many Requests', 'sendMessage', None, error_code=429, parameters={'retry_after': 3})),
+      succeed(None),
+    ])
+    results = []
+    Broadcast(self.bot, [1], send).run().addCallback(results.append)
+    self.bot.clock.pump([1] * 2)
+    self.assertEqual(results, [])
+    self.bot.clock.pump([1] * 2)
+    self.assertEqual(results[0].sent, 1)
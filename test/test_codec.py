@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import json
+from unittest import TestCase
+
+from ttbot import _convert_markup, codec, serialize_inline_results
+
+
+class TestCodec(TestCase):
+  def tearDown(self):
+    codec.use(self.backend)
+
+  def setUp(self):
+    self.backend = codec.backend
+
+  def test_backends_round_trip_bytes(self):
+    for name in ['json', 'ujson', 'orjson']:
+      try:
+        codec.use(name)
+      except ImportError:
+        continue
+      data = codec.loads(u'{"text": "привет", "url": "http://t.me/x"}'.encode('utf-8'))
+      self.assertEqual(data, {u'text': u'привет', u'url': u'http://t.me/x'})
+      self.assertEqual(codec.loads(codec.dumps(data)), data)
+      self.assertIn(u'привет', codec.dumps(data))
+
+  def test_payloads_mixing_unicode_and_utf8_str_serialize(self):
+    markup = {'keyboard': [[u'привет', 'мир']]}
+    self.assertEqual(json.loads(_convert_markup(markup)), {u'keyboard': [[u'привет', u'мир']]})
+    results = [{'type': 'article', 'id': '1', 'title': u'привет', 'description': 'мир'}]
+    self.assertEqual(json.loads(serialize_inline_results(results))[0]['description'], u'мир')
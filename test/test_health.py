@@ -0,0 +1,131 @@
+import json
+from unittest import TestCase
+
+from mock import MagicMock, patch
+from twisted.internet.defer import fail, succeed
+from twisted.internet.error import ConnectError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from ttbot import TelegramBot, ApiException
+from ttbot.health import CircuitBreaker, CircuitOpenError, HealthResource, CLOSED, OPEN, HALF_OPEN
+from ttbot.polling import AdaptivePoll
+
+
+class TestCircuitBreaker(TestCase):
+  def test_opens_probes_and_closes(self):
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+    breaker.allow()
+    breaker.record_failure()
+    breaker.record_failure()
+    self.assertEqual(breaker.state, OPEN)
+    clock.advance(10)
+    with self.assertRaises(CircuitOpenError) as cm:
+      breaker.allow()
+    self.assertEqual(cm.exception.retry_after, 20)
+
+    clock.advance(20)
+    breaker.allow()
+    self.assertEqual(breaker.state, HALF_OPEN)
+    self.assertRaises(CircuitOpenError, breaker.allow)
+    breaker.record_failure()
+    self.assertEqual(breaker.state, OPEN)
+
+    clock.advance(30)
+    breaker.allow()
+    breaker.record_success()
+    self.assertEqual(breaker.state, CLOSED)
+    breaker.allow()
+
+  def test_hung_probe_reopens_the_circuit(self):
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, probe_timeout=60, clock=clock)
+    breaker.record_failure()
+    clock.advance(30)
+    breaker.allow()
+    self.assertRaises(CircuitOpenError, breaker.allow)
+    clock.advance(60)
+    self.assertEqual(breaker.state, OPEN)
+    clock.advance(30)
+    breaker.allow()
+    self.assertEqual(breaker.state, HALF_OPEN)
+    breaker.record_cancelled()
+    breaker.allow()
+    breaker.record_success()
+    self.assertEqual(clock.getDelayedCalls(), [])
+
+  @patch('treq.request')
+  def test_bot_requests_share_the_breaker(self, request):
+    bot = TelegramBot('111:ff', 'botname', circuit_breaker=CircuitBreaker(failure_threshold=2, clock=Clock()))
+    request.side_effect = lambda *args, **kwargs: fail(ConnectError())
+    for _ in range(2):
+      bot.send_message(1, 'hi').addErrback(lambda failure: failure.trap(ConnectError))
+    self.assertEqual(bot.circuit_breaker.state, OPEN)
+
+    errback = MagicMock()
+    bot.send_message(1, 'hi').addErrback(errback)
+    self.assertTrue(errback.call_args[0][0].check(CircuitOpenError))
+    self.assertEqual(request.call_count, 2)
+    self.assertFalse(bot.health()['healthy'])
+
+  def test_client_errors_do_not_trip_the_breaker(self):
+    bot = TelegramBot('111:ff', 'botname', circuit_breaker=CircuitBreaker(failure_threshold=1, clock=Clock()))
+    bot._record_api_health(Failure(ApiException('', 'sendMessage', None, error_code=400)))
+    self.assertEqual(bot.circuit_breaker.state, CLOSED)
+    bot._record_api_health(Failure(ApiException('', 'sendMessage', None, error_code=502)))
+    self.assertEqual(bot.circuit_breaker.state, OPEN)
+
+
+class TestAdaptivePoll(TestCase):
+  def test_adjusts_limit_and_timeout(self):
+    tuner = AdaptivePoll(limit=20, timeout=10, max_limit=100, max_timeout=50)
+    tuner.observe_batch(20)
+    self.assertEqual(tuner.limit, 40)
+    tuner.observe_processing(30)
+    self.assertEqual(tuner.limit, 20)
+    tuner.observe_batch(0)
+    tuner.observe_batch(0)
+    tuner.observe_batch(0)
+    self.assertEqual(tuner.timeout, 50)
+    tuner.failed()
+    self.assertEqual(tuner.timeout, 1)
+
+
+class TestPollLoop(TestCase):
+  @patch('ttbot.reactor')
+  def test_backs_off_with_jitter_and_reports_health(self, reactor):
+    bot = TelegramBot('111:ff', 'botname')
+    bot.clock = Clock()
+    bot.get_update = MagicMock(side_effect=lambda **kwargs: fail(ConnectError()))
+    bot.start_update(backoff=1, backoff_max=8, adaptive=True)
+    start = reactor.callWhenRunning.call_args[0][0]
+
+    delays = []
+    with patch('ttbot.random.uniform', side_effect=lambda low, high: high):
+      start()
+      for _ in range(4):
+        update_bot = reactor.callLater.call_args[0][1]
+        delays.append(reactor.callLater.call_args[0][0])
+        update_bot()
+    self.assertEqual(delays, [1, 2, 4, 8])
+    self.assertEqual(bot.poll_tuner.timeout, 1)
+    self.assertFalse(bot.health()['healthy'])
+
+    bot.get_update = MagicMock(return_value=succeed(None))
+    bot.clock.advance(100)
+    reactor.callLater.call_args[0][1]()
+    self.assertEqual(bot.get_update.call_args[1], {'telegram_timeout': 1, 'limit': 100})
+    health = bot.health()
+    self.assertTrue(health['healthy'])
+    self.assertEqual(health['last_poll_age'], 0)
+
+    request = MagicMock()
+    self.assertEqual(json.loads(HealthResource(bot).render_GET(request))['poll_failures'], 0)
+    request.setResponseCode.assert_called_once_with(200)
+
+  def test_poll_request_timeout_outlasts_the_tuned_long_poll(self):
+    bot = TelegramBot('111:ff', 'botname', timeout=30, poll_tuner=AdaptivePoll(timeout=50))
+    bot._request = MagicMock(return_value=succeed([]))
+    bot.get_update(telegram_timeout=50)
+    self.assertEqual(bot._request.call_args[1]['timeout'], 55)
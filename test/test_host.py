@@ -0,0 +1,104 @@
+from unittest import TestCase
+
+from mock import MagicMock, patch
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock, deferLater
+
+from ttbot.host import BotHost, PollScheduler
+
+
+class TestPollScheduler(TestCase):
+  def test_rotates_slots_between_waiting_bots(self):
+    scheduler = PollScheduler(max_concurrent_polls=1)
+    polls = []
+
+    def get_updates(name):
+      def _get(telegram_timeout):
+        polls.append((name, telegram_timeout))
+        d = Deferred()
+        pending.append(d)
+        return d
+      return _get
+
+    pending = []
+    first = scheduler.poll(get_updates('a'), 10)
+    second = scheduler.poll(get_updates('b'), 10)
+    scheduler.poll(get_updates('c'), 10)
+    self.assertEqual(polls, [('a', 10)])
+    self.assertEqual(scheduler.waiting, 2)
+
+    callback = MagicMock()
+    first.addCallback(callback)
+    pending[0].callback([{'update_id': 1}])
+    callback.assert_called_once_with([{'update_id': 1}])
+    # c is still queued, so b polls for a shorter time but still long polls
+    self.assertEqual(polls, [('a', 10), ('b', 5)])
+
+    errback = MagicMock()
+    second.addErrback(errback)
+    pending[1].errback(RuntimeError())
+    self.assertTrue(errback.call_args[0][0].check(RuntimeError))
+    self.assertEqual(polls, [('a', 10), ('b', 5), ('c', 10)])
+
+  def test_idle_bots_do_not_busy_loop_when_outnumbering_slots(self):
+    clock = Clock()
+    scheduler = PollScheduler(max_concurrent_polls=2, contended_poll_timeout=5)
+    polls = []
+
+    def idle_bot():
+      def _get(telegram_timeout):
+        polls.append(telegram_timeout)
+        # no updates, Telegram holds the poll for the whole timeout
+        return deferLater(clock, telegram_timeout, lambda: [])
+      scheduler.poll(_get, 10).addCallback(lambda _: idle_bot())
+
+    for _ in range(10):
+      idle_bot()
+    clock.advance(1)
+    self.assertEqual(len(polls), 2)
+    for _ in range(60):
+      clock.advance(1)
+    self.assertGreaterEqual(min(polls), 5)
+    self.assertLessEqual(len(polls), 2 + 2 * 60 / 5)
+
+
+class TestBotHost(TestCase):
+  def test_bots_share_pools_and_metrics(self):
+    host = BotHost(max_concurrent_polls=5)
+    a = host.add_bot('111:aa', 'a')
+    b = host.add_bot('222:bb', 'b')
+    self.assertIs(a.pool, b.pool)
+    self.assertIs(a.poll_pool, host.poll_pool)
+    self.assertIs(a.metrics, b.metrics)
+    self.assertIs(a.poll_scheduler, host.poll_scheduler)
+    self.assertIsNot(a.message_handlers, b.message_handlers)
+    self.assertRaises(ValueError, host.add_bot, '333:cc', 'a')
+
+    # the pools belong to the host, closing one bot must not close them under the others
+    host.pool.closeCachedConnections = MagicMock()
+    host.poll_pool.closeCachedConnections = MagicMock()
+    a.close()
+    self.assertFalse(host.pool.closeCachedConnections.called)
+    self.assertFalse(host.poll_pool.closeCachedConnections.called)
+
+  def test_start_and_stop_all_bots(self):
+    host = BotHost()
+    a = host.add_bot('111:aa', 'a')
+    with patch('ttbot.reactor') as reactor:
+      host.start(pipelined=True)
+      c = host.add_bot('333:cc', 'c')
+      self.assertEqual(reactor.callWhenRunning.call_count, 2)
+    self.assertTrue(a.running and c.running)
+    self.assertIsNotNone(c.chat_queues)
+
+    b = host.add_bot('222:bb', 'b', journal=MagicMock())
+    b.start_watchdog()
+    self.assertIs(host.remove_bot('b'), b)
+    b.journal.close.assert_called_once_with()
+    self.assertIsNone(b._watchdog)
+
+    host.stop()
+    self.assertFalse(a.running or c.running)
+    self.assertTrue(a.closed and c.closed)
+    self.assertIs(host.remove_bot('c'), c)
+    self.assertEqual(list(host.bots), ['a'])
@@ -0,0 +1,103 @@
+import json
+from unittest import TestCase
+
+from mock import MagicMock
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+
+from ttbot.inline import InlineAnswer, InlineQueryLayer
+from ttbot.types import InlineQuery, User
+
+
+def _query(query_id, user_id, query, offset=''):
+  return InlineQuery(str(query_id), User(user_id, 'u'), query, offset)
+
+
+class TestInlineQueryLayer(TestCase):
+  def setUp(self):
+    self.clock = Clock()
+    self.bot = MagicMock()
+    self.bot.answer_to_inline_query.return_value = succeed(True)
+    self.pending = []
+
+    def handler(inline_query, bot):
+      d = Deferred()
+      self.pending.append(d)
+      return d
+
+    self.handler = MagicMock(side_effect=handler)
+
+  def test_drops_queries_superseded_by_the_same_user(self):
+    layer = InlineQueryLayer(self.handler, debounce=0.3, clock=self.clock)
+    layer(_query(1, 10, 'c'), self.bot)
+    self.clock.advance(0.1)
+    layer(_query(2, 10, 'ca'), self.bot)
+    self.clock.advance(0.2)
+    self.assertFalse(self.handler.called)
+
+    self.clock.advance(0.1)
+    self.assertEqual(self.handler.call_args[0][0].query, 'ca')
+    layer(_query(3, 10, 'cat'), self.bot)
+    self.pending[0].callback([{'type': 'article', 'id': '1'}])
+    self.assertFalse(self.bot.answer_to_inline_query.called)
+    self.assertEqual(layer.dropped, 2)
+
+    self.clock.advance(0.3)
+    self.pending[1].callback(InlineAnswer([], next_offset='10'))
+    self.bot.answer_to_inline_query.assert_called_once_with('3', '[]', False, '10', None, None)
+    self.assertEqual(layer._latest, {})
+
+  def test_coalesces_and_caches_serialized_results(self):
+    layer = InlineQueryLayer(self.handler, debounce=0, cache_ttl=60, clock=self.clock)
+    layer(_query(1, 10, 'cat'), self.bot)
+    layer(_query(2, 11, 'cat'), self.bot)
+    self.assertEqual(self.handler.call_count, 1)
+    self.pending[0].callback([{'type': 'article', 'id': '1'}])
+    self.assertEqual(self.bot.answer_to_inline_query.call_count, 2)
+    self.assertEqual(json.loads(self.bot.answer_to_inline_query.call_args[0][1]), [{'type': 'article', 'id': '1'}])
+
+    layer(_query(3, 12, 'cat'), self.bot)
+    self.assertEqual(self.handler.call_count, 1)
+    self.assertEqual((layer.misses, layer.coalesced, layer.hits), (1, 1, 1))
+
+    self.clock.advance(61)
+    layer(_query(4, 12, 'cat'), self.bot)
+    self.assertEqual(self.handler.call_count, 2)
+
+  def test_personal_results_are_cached_per_user(self):
+    layer = InlineQueryLayer(self.handler, debounce=0, personal=True, clock=self.clock)
+    failed = layer(_query(1, 10, 'cat'), self.bot)
+    layer(_query(2, 11, 'cat'), self.bot)
+    self.assertEqual(self.handler.call_count, 2)
+    self.pending[0].errback(RuntimeError())
+    self.assertTrue(failed.called)
+    failed.addErrback(lambda failure: failure.trap(RuntimeError))
+    self.pending[1].callback([])
+    self.bot.answer_to_inline_query.assert_called_once_with('2', '[]', True, '', None, None)
+
+  def test_personal_answers_are_not_shared(self):
+    layer = InlineQueryLayer(self.handler, debounce=0, clock=self.clock)
+    layer(_query(1, 10, 'me'), self.bot)
+    layer(_query(2, 11, 'me'), self.bot)
+    self.pending[0].callback(InlineAnswer([{'type': 'article', 'id': 'ten'}], personal=True))
+    self.assertEqual(self.handler.call_count, 2)
+    self.assertEqual(self.bot.answer_to_inline_query.call_count, 1)
+    self.pending[1].callback(InlineAnswer([{'type': 'article', 'id': 'eleven'}], personal=True))
+    answers = dict((call[0][0], json.loads(call[0][1])[0]['id'])
+                   for call in self.bot.answer_to_inline_query.call_args_list)
+    self.assertEqual(answers, {'1': 'ten', '2': 'eleven'})
+
+    layer(_query(3, 12, 'me'), self.bot)
+    self.assertEqual(self.handler.call_count, 3)
+    layer(_query(4, 10, 'me'), self.bot)
+    self.assertEqual(self.handler.call_count, 3)
+    self.assertEqual(json.loads(self.bot.answer_to_inline_query.call_args[0][1])[0]['id'], 'ten')
+
+  def test_cache_hits_are_not_debounced(self):
+    layer = InlineQueryLayer(self.handler, debounce=0.3, clock=self.clock)
+    layer(_query(1, 10, 'cat'), self.bot)
+    self.clock.advance(0.3)
+    self.pending[0].callback([])
+    layer(_query(2, 11, 'cat'), self.bot)
+    self.assertEqual(self.bot.answer_to_inline_query.call_count, 2)
+    self.assertEqual(layer.hits, 1)
@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import MagicMock, patch
+from twisted.internet.defer import Deferred, succeed
+
+from ttbot import TelegramBot
+from ttbot.journal import UpdateJournal
+
+
+def _update(update_id):
+  return {'update_id': update_id, 'inline_query': {'id': str(update_id), 'from': {'id': 1, 'first_name': 'u'},
+                                                   'query': 'q', 'offset': ''}}
+
+
+class TestUpdateJournal(TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'updates.journal')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_recovers_offset_and_unfinished_updates(self):
+    journal = UpdateJournal(self.path)
+    self.assertEqual(journal.record([_update(1), _update(2), _update(3)]), [_update(1), _update(2), _update(3)])
+    journal.complete([1, 3])
+    journal.commit(1)
+    journal.close()
+    with open(self.path, 'ab') as f:
+      f.write(b'{"u": {"upd')
+
+    journal = UpdateJournal(self.path)
+    self.assertEqual(journal.offset, 1)
+    self.assertEqual(journal.pending_updates(), [_update(2)])
+    self.assertEqual(journal.last_journaled_id, 3)
+    # redelivered by Telegram, but already journaled
+    self.assertEqual(journal.record([_update(1), _update(3), _update(4)]), [_update(4)])
+    journal.close()
+
+  def test_compaction_keeps_state(self):
+    journal = UpdateJournal(self.path, compact_every=6)
+    journal.record([_update(1), _update(2), _update(3)])
+    journal.complete([1, 3])
+    journal.commit(1)
+    journal.close()
+    with open(self.path, 'rb') as f:
+      self.assertEqual(len(f.readlines()), 3)
+
+    journal = UpdateJournal(self.path)
+    self.assertEqual(journal.offset, 1)
+    self.assertEqual(journal.pending_updates(), [_update(2)])
+    self.assertEqual(journal.record([_update(3)]), [])
+    journal.close()
+
+  def test_bot_replays_and_commits(self):
+    journal = UpdateJournal(self.path)
+    journal.record([_update(5), _update(6)])
+    journal.complete([6])
+    journal.commit(4)
+    journal.close()
+
+    bot = TelegramBot('111:ff', 'test', journal=UpdateJournal(self.path))
+    bot.inline_query_handler = MagicMock()
+    bot._replay_journal()
+    self.assertEqual([call[0][0].query_id for call in bot.inline_query_handler.call_args_list], ['5'])
+    self.assertEqual(bot.last_update_id, 6)
+
+    bot._request = MagicMock(return_value=succeed([_update(6), _update(7)]))
+    bot.get_update()
+    self.assertEqual(bot._request.call_args[1]['params']['offset'], 7)
+    self.assertEqual([call[0][0].query_id for call in bot.inline_query_handler.call_args_list], ['5', '7'])
+    self.assertEqual(bot.last_update_id, 7)
+    bot.journal.close()
+    self.assertEqual(UpdateJournal(self.path).offset, 7)
+
+  def test_torn_last_record_does_not_swallow_the_next_one(self):
+    journal = UpdateJournal(self.path)
+    journal.record([_update(1)])
+    journal.close()
+    with open(self.path, 'ab') as f:
+      f.write(b'{"u": {"update_id": 2, "inl')
+
+    journal = UpdateJournal(self.path)
+    journal.record([_update(3)])
+    journal.close()
+    self.assertEqual([update['update_id'] for update in UpdateJournal(self.path).pending_updates()], [1, 3])
+
+  def test_pipelined_polls_past_journaled_updates_in_flight(self):
+    bot = TelegramBot('111:ff', 'test', journal=UpdateJournal(self.path))
+    slow = Deferred()
+    bot.inline_query_handler = MagicMock(side_effect=lambda query, bot: slow)
+    bot._request = MagicMock(return_value=succeed([_update(1), _update(2)]))
+    bot.get_update_pipelined()
+    bot._request = MagicMock(return_value=succeed([]))
+    bot.get_update_pipelined()
+    self.assertEqual(bot._request.call_args[1]['params']['offset'], 3)
+    self.assertEqual(bot.last_update_id, -1)
+    bot.journal.close()
+    self.assertEqual([update['update_id'] for update in UpdateJournal(self.path).pending_updates()], [1, 2])
+
+  def test_webhook_updates_are_replayed_and_forgotten(self):
+    journal = UpdateJournal(self.path)
+    journal.record([_update(5)])
+    journal.close()
+
+    bot = TelegramBot('111:ff', 'test', journal=UpdateJournal(self.path, compact_every=4, max_completed=2))
+    bot.inline_query_handler = MagicMock()
+    bot.set_webhook = MagicMock(return_value=succeed(True))
+    with patch('ttbot.reactor'):
+      bot.start_webhook('https://example.com/hook', 8443)
+    self.assertEqual([call[0][0].query_id for call in bot.inline_query_handler.call_args_list], ['5'])
+    self.assertIsNone(bot.journal.offset)
+
+    slow = Deferred()
+    bot.inline_query_handler = MagicMock(side_effect=lambda query, bot: slow if query.query_id == '7' else None)
+    bot.process_webhook_update(_update(7))
+    bot.process_webhook_update(_update(8))
+    # 6 arrives after 8 has finished and is still handled
+    bot.process_webhook_update(_update(6))
+    self.assertEqual([call[0][0].query_id for call in bot.inline_query_handler.call_args_list], ['7', '8', '6'])
+    self.assertEqual(bot.journal.pending_updates(), [_update(7)])
+    slow.callback(None)
+    self.assertEqual(bot.journal.pending_updates(), [])
+    self.assertEqual(bot.journal._journaled, set([6, 7]))
+    self.assertEqual(bot.journal.record([_update(7)]), [])
+    bot.journal.close()
+
+    with open(self.path, 'rb') as f:
+      self.assertLessEqual(len(f.readlines()), 4)
+    journal = UpdateJournal(self.path)
+    self.assertIsNone(journal.offset)
+    self.assertEqual(journal.record([_update(6), _update(7)]), [])
+    journal.close()
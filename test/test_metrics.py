@@ -0,0 +1,50 @@
+import json
+from unittest import TestCase
+
+from mock import MagicMock, patch
+from twisted.internet.defer import succeed, fail
+from twisted.internet.task import Clock
+
+from ttbot import TelegramBot, Message
+from ttbot.metrics import Metrics
+from ttbot.types import User
+
+
+class TestMetrics(TestCase):
+  def test_render_histogram_and_counter(self):
+    metrics = Metrics()
+    metrics.api_request_duration.observe(0.02, ('bot', 'getMe'))
+    metrics.api_request_duration.observe(3, ('bot', 'getMe'))
+    metrics.api_responses.inc(('bot', 'getMe', '200'))
+
+    text = metrics.render()
+    self.assertIn('# TYPE ttbot_api_request_duration_seconds histogram', text)
+    self.assertIn('ttbot_api_request_duration_seconds_bucket{bot="bot",method="getMe",le="0.025"} 1', text)
+    self.assertIn('ttbot_api_request_duration_seconds_bucket{bot="bot",method="getMe",le="+Inf"} 2', text)
+    self.assertIn('ttbot_api_request_duration_seconds_count{bot="bot",method="getMe"} 2', text)
+    self.assertIn('ttbot_api_responses_total{bot="bot",method="getMe",status="200"} 1', text)
+
+  @patch('ttbot.treq.request')
+  def test_bot_records_requests_handlers_and_gauges(self, request):
+    metrics = Metrics()
+    bot = TelegramBot("111:ff", "botname", metrics=metrics)
+    bot.clock = Clock()
+
+    resp = MagicMock()
+    resp.code = 200
+    resp.content.return_value = succeed(json.dumps({'ok': True, 'result': []}))
+    request.return_value = succeed(resp)
+    bot._make_request('getUpdates')
+
+    def echo(message, bot):
+      bot.clock.advance(0.5)
+      return fail(ValueError())
+
+    bot.register_message_handler(echo, func=lambda m: True)
+    bot.process_message(Message(1, None, None, User(1, None), 'text', {'text': 'hi'})).addErrback(lambda _: None)
+
+    text = metrics.render()
+    self.assertIn('ttbot_api_responses_total{bot="botname",method="getUpdates",status="200"} 1', text)
+    self.assertIn('ttbot_handler_duration_seconds_sum{bot="botname",handler="echo"} 0.5', text)
+    self.assertIn('ttbot_handler_errors_total{bot="botname",handler="echo"} 1', text)
+    self.assertIn('ttbot_updates_in_flight{bot="botname"} 0', text)
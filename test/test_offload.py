@@ -0,0 +1,70 @@
+import threading
+from unittest import TestCase
+
+from mock import MagicMock, patch
+from twisted.internet.defer import succeed
+
+from ttbot import TelegramBot
+from ttbot.offload import BotProxy, ProcessOffload, ThreadOffload, _call_safely
+
+
+def square(x):
+  return x * x
+
+
+def make_lock():
+  return threading.Lock()
+
+
+class TestBotProxy(TestCase):
+  def test_calls_bot_methods_on_the_reactor_thread(self):
+    reactor = MagicMock()
+    bot = MagicMock()
+    bot.name = 'botname'
+    proxy = BotProxy(bot, reactor)
+    with patch('ttbot.offload.blockingCallFromThread', return_value='sent') as blocking:
+      self.assertEqual(proxy.send_message(1, 'hi'), 'sent')
+    blocking.assert_called_once_with(reactor, bot.send_message, 1, 'hi')
+    self.assertEqual(proxy.name, 'botname')
+
+
+class TestOffload(TestCase):
+  def test_thread_handler_gets_a_proxy(self):
+    reactor = MagicMock()
+    offload = ThreadOffload(max_threads=1, reactor=reactor)
+    offload.run = MagicMock(return_value=succeed(None))
+    bot = TelegramBot('111:ff', 'botname')
+    handler = MagicMock(__name__='handler')
+    bot.register_message_handler(handler, commands=['heavy'], offload=offload)
+
+    wrapped = bot.message_handlers[0]['function']
+    wrapped('message', bot)
+    fn, update, proxy = offload.run.call_args[0]
+    self.assertIs(fn, handler)
+    self.assertIsInstance(proxy, BotProxy)
+    offload.close()
+    reactor.removeSystemEventTrigger.assert_called_once_with(reactor.addSystemEventTrigger.return_value)
+
+  def test_process_failures_come_back_as_results(self):
+    self.assertEqual(_call_safely(square, (3,), {}), (True, 9))
+    ok, (error, remote_traceback) = _call_safely(square, (None,), {})
+    self.assertFalse(ok)
+    self.assertIsInstance(error, TypeError)
+    self.assertIn('square', remote_traceback)
+
+  def test_unpicklable_results_come_back_as_failures(self):
+    ok, (error, remote_traceback) = _call_safely(make_lock, (), {})
+    self.assertFalse(ok)
+    self.assertIn('pickle', remote_traceback)
+
+  def test_process_offload_runs_in_pool(self):
+    reactor = MagicMock()
+    reactor.callFromThread.side_effect = lambda f, *args: f(*args)
+    offload = ProcessOffload(processes=1, reactor=reactor)
+    done = threading.Event()
+    results = []
+    d = offload.run(square, 7)
+    d.addBoth(results.append).addBoth(lambda _: done.set())
+    done.wait(10)
+    self.assertEqual(results, [49])
+    offload.pool.terminate()
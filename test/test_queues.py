@@ -0,0 +1,76 @@
+from unittest import TestCase
+
+from mock import MagicMock
+from twisted.internet.defer import Deferred
+
+from ttbot.queues import ChatQueues, QueueFullError
+
+
+class TestChatQueues(TestCase):
+  def test_keeps_order_per_chat_and_limits_concurrency(self):
+    queues = ChatQueues(max_concurrency=2, max_queue_length=2)
+    pending = {}
+    calls = []
+
+    def job(name):
+      calls.append(name)
+      pending[name] = Deferred()
+      return pending[name]
+
+    queues.enqueue(1, job, 'a1')
+    queues.enqueue(1, job, 'a2')
+    queues.enqueue(2, job, 'b1')
+    queues.enqueue(3, job, 'c1')
+    self.assertEqual(calls, ['a1', 'b1'])
+
+    errback = MagicMock()
+    queues.enqueue(1, job, 'a3').addErrback(errback)
+    self.assertTrue(errback.call_args[0][0].check(QueueFullError))
+
+    pending['b1'].callback(None)
+    self.assertEqual(calls, ['a1', 'b1', 'c1'])
+    self.assertEqual(queues.chats, 2)
+
+    pending['a1'].callback(None)
+    pending['c1'].callback(None)
+    pending['a2'].callback(None)
+    self.assertEqual(calls, ['a1', 'b1', 'c1', 'a2'])
+    self.assertEqual(queues.chats, 0)
+    self.assertEqual(queues.running, 0)
+
+  def test_synchronous_jobs_do_not_recurse(self):
+    queues = ChatQueues(max_concurrency=1, max_queue_length=10000)
+    done = []
+    blocker = Deferred()
+    queues.enqueue(1, lambda: blocker)
+    for i in range(5000):
+      queues.enqueue(2, done.append, i)
+    blocker.callback(None)
+    self.assertEqual(len(done), 5000)
+
+  def test_put_holds_jobs_back_until_the_chat_has_room(self):
+    queues = ChatQueues(max_concurrency=10, max_queue_length=1)
+    pending = {}
+    calls = []
+
+    def job(name):
+      calls.append(name)
+      pending[name] = Deferred()
+      return pending[name]
+
+    done = []
+    for name in ('a1', 'a2', 'a3'):
+      queues.put(1, job, name).addCallback(lambda _, name=name: done.append(name))
+    self.assertEqual(calls, ['a1'])
+    self.assertEqual(len(queues), 3)
+
+    errback = MagicMock()
+    queues.enqueue(1, job, 'a4').addErrback(errback)
+    self.assertTrue(errback.call_args[0][0].check(QueueFullError))
+
+    pending['a1'].callback(None)
+    self.assertEqual(calls, ['a1', 'a2'])
+    pending['a2'].callback(None)
+    pending['a3'].callback(None)
+    self.assertEqual(done, ['a1', 'a2', 'a3'])
+    self.assertEqual(queues.chats, 0)
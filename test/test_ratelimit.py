@@ -0,0 +1,56 @@
+from unittest import TestCase
+
+from twisted.internet.task import Clock
+
+from ttbot.ratelimit import RateLimiter, PRIORITY_HIGH, PRIORITY_BULK
+
+
+class TestRateLimiter(TestCase):
+  def test_paces_per_chat_and_prefers_higher_priority(self):
+    clock = Clock()
+    limiter = RateLimiter(clock=clock, global_rate=2, global_burst=2)
+    fired = []
+
+    def acquire(name, chat_id, priority):
+      limiter.acquire(chat_id, priority).addCallback(lambda _: fired.append(name))
+
+    acquire('a1', 1, PRIORITY_BULK)
+    acquire('a2', 1, PRIORITY_BULK)
+    acquire('b1', 2, PRIORITY_BULK)
+    acquire('c1', 3, PRIORITY_HIGH)
+    self.assertEqual(fired, ['a1'])
+    self.assertEqual(limiter.queue_depth(), 3)
+
+    clock.advance(0)
+    self.assertEqual(fired, ['a1', 'c1'])
+
+    clock.advance(0.5)
+    self.assertEqual(fired, ['a1', 'c1', 'b1'])
+
+    clock.advance(0.5)
+    self.assertEqual(fired, ['a1', 'c1', 'b1', 'a2'])
+    self.assertEqual(limiter.queue_depth(), 0)
+
+  def test_group_chats_are_limited_per_minute(self):
+    clock = Clock()
+    limiter = RateLimiter(clock=clock)
+    fired = []
+    for i in range(3):
+      limiter.acquire(-100, PRIORITY_BULK).addCallback(fired.append)
+
+    clock.pump([1] * 5)
+    self.assertEqual(len(fired), 2)
+    clock.pump([1] * 3)
+    self.assertEqual(len(fired), 3)
+
+  def test_int_and_str_chat_ids_share_a_bucket(self):
+    clock = Clock()
+    limiter = RateLimiter(clock=clock)
+    fired = []
+    limiter.acquire(42).addCallback(lambda _: fired.append('int'))
+    limiter.acquire('42').addCallback(lambda _: fired.append('str'))
+
+    clock.advance(0)
+    self.assertEqual(fired, ['int'])
+    clock.advance(1)
+    self.assertEqual(fired, ['int', 'str'])
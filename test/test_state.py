@@ -0,0 +1,77 @@
+import functools
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import MagicMock
+from twisted.internet.task import Clock
+
+from ttbot.types import Message
+from ttbot.state import MemoryStateStore, ShelveStateStore, EVICTED_CAPACITY, EVICTED_EXPIRED
+
+
+def handler(message, bot):
+  pass
+
+
+class TestMemoryStateStore(TestCase):
+  def test_evicts_least_recently_used(self):
+    on_evict = MagicMock()
+    store = MemoryStateStore(maxsize=2, on_evict=on_evict, clock=Clock())
+    store[1] = 'a'
+    store[2] = 'b'
+    self.assertEqual(store.get(1), 'a')
+    store[3] = 'c'
+    on_evict.assert_called_once_with(2, 'b', EVICTED_CAPACITY)
+    self.assertEqual(store.evictions, 1)
+    self.assertEqual(store.pop(1), 'a')
+    self.assertIsNone(store.pop(2))
+    self.assertEqual(len(store), 1)
+
+  def test_expires_entries(self):
+    clock = Clock()
+    on_evict = MagicMock()
+    store = MemoryStateStore(ttl=10, on_evict=on_evict, clock=clock)
+    store[1] = 'a'
+    store.set(2, 'b', ttl=30)
+    clock.advance(5)
+    store[1] = 'a2'
+    clock.advance(6)
+    self.assertIn(1, store)
+    clock.advance(5)
+    self.assertNotIn(1, store)
+    on_evict.assert_called_once_with(1, 'a2', EVICTED_EXPIRED)
+    self.assertEqual(store.expirations, 1)
+    self.assertEqual(store.pop(2), 'b')
+
+  def test_stale_expiry_entries_are_compacted(self):
+    clock = Clock()
+    store = MemoryStateStore(ttl=10, clock=clock)
+    for i in range(1000):
+      store[1] = i
+    self.assertLess(len(store._expiry), 100)
+    self.assertEqual(store[1], 999)
+
+
+class TestShelveStateStore(TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'state')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_survives_restart(self):
+    clock = Clock()
+    store = ShelveStateStore(self.path, clock=clock)
+    store[123] = handler
+    store.set('short', handler, ttl=5)
+    store.close()
+
+    clock.advance(10)
+    store = ShelveStateStore(self.path, clock=clock)
+    self.assertIs(store.pop(123), handler)
+    self.assertNotIn('short', store)
+    self.assertEqual(len(store), 0)
+    store.close()
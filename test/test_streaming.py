@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import TestCase
+
+from mock import MagicMock
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+from zope.interface import implementer
+
+from ttbot import ApiException, TelegramBot
+from ttbot.mediacache import MediaCache
+from ttbot.streaming import FileTooLargeError, InputFile, ProgressProducer, stream_body_to_path
+
+
+class FakeResponse(object):
+  def __init__(self, chunks):
+    self.chunks = chunks
+    self.transport = MagicMock()
+
+  def deliverBody(self, protocol):
+    protocol.makeConnection(self.transport)
+    for chunk in self.chunks:
+      protocol.dataReceived(chunk)
+    protocol.connectionLost(Failure(ResponseDone()))
+
+
+class TestStreamBodyToPath(TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'voice.ogg')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_writes_chunks_to_path(self):
+    sizes = []
+    stream_body_to_path(FakeResponse([b'abc', b'def']), self.path).addCallback(sizes.append)
+
+    self.assertEqual(sizes, [6])
+    with open(self.path, 'rb') as f:
+      self.assertEqual(f.read(), b'abcdef')
+
+  def test_stops_at_size_cap(self):
+    response = FakeResponse([b'abc', b'def'])
+    errors = []
+    stream_body_to_path(response, self.path, max_size=4).addErrback(errors.append)
+
+    self.assertTrue(errors[0].check(FileTooLargeError))
+    response.transport.stopProducing.assert_called_once_with()
+    self.assertEqual(os.listdir(self.directory), [])
+
+
+@implementer(IBodyProducer)
+class UnknownLengthProducer(object):
+  length = UNKNOWN_LENGTH
+
+
+class TestUploads(TestCase):
+  def test_progress_producer_reports_bytes_sent(self):
+    producer = MagicMock()
+    producer.length = 6
+    producer.startProducing.side_effect = lambda consumer: [consumer.write(b'abc'), consumer.write(b'def')]
+    progress = MagicMock()
+    consumer = MagicMock()
+
+    ProgressProducer(producer, progress).startProducing(consumer)
+
+    self.assertEqual(progress.call_args_list, [((3, 6),), ((6, 6),)])
+    self.assertEqual(consumer.write.call_count, 2)
+
+  def test_input_file_requires_known_length(self):
+    self.assertRaises(ValueError, InputFile(UnknownLengthProducer()).open)
+
+  def test_send_document_streams_file_object(self):
+    bot = TelegramBot("111:ff", "botname")
+    bot._request = MagicMock(return_value=succeed({'message_id': 1, 'date': 0,
+                                                   'chat': {'id': 1, 'type': 'private'},
+                                                   'document': {'file_id': 'doc'}}))
+    fileobj = BytesIO(b'content')
+    fileobj.name = '/tmp/report.pdf'
+
+    message = []
+    bot.send_document(1, fileobj, caption='report').addCallback(message.append)
+
+    files = bot._request.call_args[1]['files']
+    filename, content_type, producer = files['document']
+    self.assertEqual(filename, 'report.pdf')
+    self.assertEqual(producer.length, 7)
+    self.assertEqual(fileobj.tell(), 0)
+    self.assertEqual(bot._request.call_args[1]['params']['caption'], 'report')
+    self.assertEqual(message[0].document.file_id, 'doc')
+
+
+class TestMediaCache(TestCase):
+  def test_reuses_file_id_and_deduplicates_uploads(self):
+    bot = TelegramBot("111:ff", "botname", media_cache=MediaCache())
+    uploads = []
+
+    def request(method, http_method, params=None, files=None, **kwargs):
+      d = Deferred()
+      uploads.append((params, files, d))
+      return d
+
+    bot._request = MagicMock(side_effect=request)
+    sent = []
+    bot.send_voice(1, BytesIO(b'voice')).addCallback(sent.append)
+    bot.send_voice(2, BytesIO(b'voice')).addCallback(sent.append)
+    self.assertEqual(len(uploads), 1)
+    self.assertIn('voice', uploads[0][1])
+
+    uploads[0][2].callback({'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                            'voice': {'file_id': 'VOICE', 'duration': 1}})
+    self.assertEqual(len(uploads), 2)
+    self.assertEqual(uploads[1][0]['voice'], 'VOICE')
+    self.assertIsNone(uploads[1][1])
+
+    bot.send_voice(3, BytesIO(b'voice'))
+    self.assertEqual(uploads[2][0]['voice'], 'VOICE')
+    bot.send_voice(3, BytesIO(b'other voice'))
+    self.assertIn('voice', uploads[3][1])
+
+  def test_rejected_file_id_is_evicted_and_uploaded_again(self):
+    cache = MediaCache()
+    cache.set('111:voice:report', 'STALE')
+    bot = TelegramBot("111:ff", "botname", media_cache=cache)
+    uploads = []
+
+    def request(method, http_method, params=None, files=None, **kwargs):
+      uploads.append((params, files))
+      if params.get('voice') == 'STALE':
+        return fail(ApiException('Bad Request', method, None, error_code=400,
+                                 description='Bad Request: wrong file identifier/HTTP URL specified'))
+      return succeed({'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                      'voice': {'file_id': 'FRESH', 'duration': 1}})
+
+    bot._request = MagicMock(side_effect=request)
+    sent = []
+    bot.send_voice(1, BytesIO(b'voice'), cache_key='report').addCallback(sent.append)
+
+    self.assertEqual(len(uploads), 2)
+    self.assertIn('voice', uploads[1][1])
+    self.assertEqual(sent[0].voice.file_id, 'FRESH')
+    self.assertEqual(cache.get('111:voice:report'), 'FRESH')
+
+  def test_other_bad_requests_keep_the_cached_file_id(self):
+    cache = MediaCache()
+    cache.set('111:voice:report', 'VOICE')
+    bot = TelegramBot("111:ff", "botname", media_cache=cache)
+    errors = [ApiException('Bad Request', 'sendVoice', None, error_code=400, description='Bad Request: chat not found'),
+              ApiException('Bad Request', 'sendVoice', None, error_code=400,
+                           description='Bad Request: group chat was upgraded to a supergroup chat',
+                           parameters={'migrate_to_chat_id': -1001})]
+    for error in errors:
+      bot._request = MagicMock(side_effect=lambda *args, **kwargs: fail(error))
+      errback = MagicMock()
+      bot.send_voice(1, BytesIO(b'voice'), cache_key='report').addErrback(errback)
+      self.assertIs(errback.call_args[0][0].value, error)
+      self.assertEqual(bot._request.call_count, 1)
+      self.assertEqual(cache.get('111:voice:report'), 'VOICE')
+
+  def test_file_ids_are_cached_per_bot(self):
+    cache = MediaCache()
+    cache.set('111:voice:report', 'VOICE')
+    bot = TelegramBot("222:ff", "other", media_cache=cache)
+    bot._request = MagicMock(return_value=Deferred())
+    bot.send_voice(1, BytesIO(b'voice'), cache_key='report')
+    self.assertIn('voice', bot._request.call_args[1]['files'])
@@ -1,10 +1,21 @@
+import json
 from unittest import TestCase
-from mock import MagicMock, call
+from mock import MagicMock, call, patch
+from twisted.internet.defer import CancelledError, Deferred, succeed
+from twisted.internet.task import Clock
 
-from ttbot import TelegramBot, Message
+from ttbot import TelegramBot, Message, ApiException, RequestTimeoutError
 from ttbot.types import User
 
 
+def _response(code, body):
+  resp = MagicMock()
+  resp.code = code
+  resp.phrase = 'phrase'
+  resp.content.return_value = succeed(json.dumps(body))
+  return resp
+
+
 class TestTelegramBot(TestCase):
   def test_process_messages(self):
     bot = TelegramBot("111:ff", "botname")
@@ -38,3 +49,214 @@ class TestTelegramBot(TestCase):
         call(messages[9]),
       ]
     )
+
+  def test_process_updates_parallel_with_handler_is_a_staticmethod(self):
+    handler = MagicMock(return_value=None)
+    TelegramBot.process_updates_parallel_with_handler(handler, ['a', 'b'], 'bot')
+    self.assertEqual(handler.call_args_list, [call('a', 'bot'), call('b', 'bot')])
+
+  def test_get_update_pipelined_commits_contiguous_offset(self):
+    bot = TelegramBot("111:ff", "botname")
+
+    batches = [Deferred(), Deferred()]
+    bot.process_raw_updates = MagicMock(side_effect=batches)
+
+    bot._poll_updates = MagicMock(return_value=succeed([{'update_id': 10}, {'update_id': 11}]))
+    bot.get_update_pipelined()
+    bot._poll_updates = MagicMock(return_value=succeed([{'update_id': 10}, {'update_id': 11}, {'update_id': 12}]))
+    bot.get_update_pipelined()
+
+    # without a journal, polls go on from the committed offset so nothing in flight is confirmed
+    self.assertEqual(bot._poll_updates.call_args[0][3], 0)
+    bot.process_raw_updates.assert_called_with([{'update_id': 12}])
+    self.assertEqual(bot.last_update_id, -1)
+
+    batches[1].callback(None)
+    self.assertEqual(bot.last_update_id, -1)
+
+    batches[0].callback(None)
+    self.assertEqual(bot.last_update_id, 12)
+    self.assertEqual(bot._pending_updates, {})
+
+  def test_get_update_pipelined_fetches_a_failed_batch_again(self):
+    bot = TelegramBot("111:ff", "botname")
+    bot.process_raw_updates = MagicMock(side_effect=KeyError('message'))
+    bot._poll_updates = MagicMock(side_effect=lambda *args: succeed([{'update_id': 10}]))
+    errback = MagicMock()
+    bot.get_update_pipelined().addErrback(errback)
+    self.assertTrue(errback.call_args[0][0].check(KeyError))
+    self.assertEqual((bot._pending_updates, bot._pending_update_ids, bot._fetched_update_id), ({}, [], -2))
+
+    bot.process_raw_updates = MagicMock(return_value=succeed(None))
+    bot.get_update_pipelined()
+    bot.process_raw_updates.assert_called_once_with([{'update_id': 10}])
+    self.assertEqual(bot.last_update_id, 10)
+
+  def test_find_command_handler_function_keeps_first_match(self):
+    bot = TelegramBot("111:ff", "botname")
+
+    handlers = [MagicMock(name='handler%d' % i) for i in range(7)]
+    bot.register_message_handler(handlers[0], func=lambda m: m.text == 'exact')
+    bot.register_message_handler(handlers[1], commands=['start', 'help'])
+    bot.register_message_handler(handlers[2], commands=['st.*'], regexp='never')
+    bot.register_message_handler(handlers[3], regexp='^/stop')
+    bot.register_message_handler(handlers[4], commands=['stop'], regexp='hello')
+    bot.register_message_handler(handlers[5], func=lambda m: True, content_types=['photo'])
+    bot.register_message_handler(handlers[6], func=lambda m: True)
+
+    def message(text, content_type='text'):
+      return Message(1, None, None, User(1, None), content_type, {'text': text})
+
+    for msg in [message('exact'), message('/start'), message('/Help@botname arg'), message('/stay'),
+                message('/stop'), message('/unknown'), message('hello'), message('plain'),
+                message(None, 'photo'), message(None, 'audio')]:
+      expected = None
+      for message_handler in bot.message_handlers:
+        if bot._test_message_handler(message_handler, msg):
+          expected = message_handler['function']
+          break
+      self.assertIs(bot._find_command_handler_function(msg), expected, msg.text)
+
+    bot.message_handlers.insert(0, {'function': handlers[0], 'content_types': ['text'], 'lambda': lambda m: True})
+    self.assertIs(bot._find_command_handler_function(message('/start')), handlers[0])
+
+  @patch('ttbot.treq.request')
+  def test_make_request_waits_retry_after(self, request):
+    bot = TelegramBot("111:ff", "botname", max_retries=2)
+    bot.clock = Clock()
+    request.side_effect = [
+      succeed(_response(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                              'parameters': {'retry_after': 5}})),
+      succeed(_response(200, {'ok': True, 'result': True})),
+    ]
+
+    results = []
+    bot._make_request('sendMessage', 'POST', params={'chat_id': '1', 'text': 'hi'}).addCallback(results.append)
+    bot.clock.advance(4.9)
+    self.assertEqual(results, [])
+    bot.clock.advance(0.1)
+    self.assertEqual(results, [{'ok': True, 'result': True}])
+
+  @patch('ttbot.treq.request')
+  def test_make_request_follows_chat_migration(self, request):
+    bot = TelegramBot("111:ff", "botname")
+    request.side_effect = [
+      succeed(_response(400, {'ok': False, 'error_code': 400, 'description': 'group chat was upgraded',
+                              'parameters': {'migrate_to_chat_id': -1002}})),
+      succeed(_response(200, {'ok': True, 'result': True})),
+      succeed(_response(500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'})),
+    ]
+
+    bot._make_request('sendMessage', 'POST', params={'chat_id': '-1', 'text': 'hi'})
+    self.assertEqual(request.call_args[1]['params']['chat_id'], '-1002')
+
+    errors = []
+    bot._make_request('sendMessage', 'POST', params={'chat_id': -1, 'text': 'hi'}).addErrback(errors.append)
+    self.assertEqual(request.call_args[1]['params']['chat_id'], '-1002')
+    self.assertEqual(errors[0].value.error_code, 500)
+    self.assertIsInstance(errors[0].value, ApiException)
+
+  @patch('ttbot.treq.request')
+  def test_make_request_polls_on_dedicated_connection(self, request):
+    bot = TelegramBot("111:ff", "botname", pool_size=4)
+    request.side_effect = lambda *args, **kwargs: succeed(_response(200, {'ok': True, 'result': []}))
+
+    bot._make_request('getUpdates', params={'offset': 0})
+    self.assertIs(request.call_args[1]['agent'], bot.poll_agent)
+    bot._make_request('sendMessage', 'POST', params={'chat_id': '1', 'text': 'hi'})
+    self.assertIs(request.call_args[1]['agent'], bot.agent)
+
+    self.assertEqual(bot.pool.maxPersistentPerHost, 4)
+    self.assertEqual(bot.poll_pool.maxPersistentPerHost, 1)
+
+  def test_get_file_is_cached_and_coalesced(self):
+    bot = TelegramBot("111:ff", "botname")
+    response = Deferred()
+    bot._request = MagicMock(return_value=response)
+
+    files = []
+    bot.get_file('abc').addCallback(files.append)
+    bot.get_file('abc').addCallback(files.append)
+    self.assertEqual(bot._request.call_count, 1)
+
+    response.callback({'file_id': 'abc', 'file_size': 10, 'file_path': 'voice/file_1.oga'})
+    self.assertEqual(len(files), 2)
+    self.assertIs(files[0], files[1])
+
+    bot.get_file('abc').addCallback(files.append)
+    self.assertEqual(bot._request.call_count, 1)
+    self.assertIs(files[2], files[0])
+    self.assertEqual(bot.get_file_url('abc'), 'https://api.telegram.org/file/bot111:ff/voice/file_1.oga')
+    self.assertRaises(ValueError, bot.get_file_url, 'missing')
+
+  def test_get_file_waiters_fire_when_the_result_is_malformed(self):
+    bot = TelegramBot("111:ff", "botname")
+    response = Deferred()
+    bot._request = MagicMock(return_value=response)
+
+    errors = []
+    bot.get_file('abc').addErrback(errors.append)
+    bot.get_file('abc').addErrback(errors.append)
+    response.callback(None)
+    self.assertEqual(len(errors), 2)
+    self.assertNotIn('abc', bot._file_requests)
+
+  def test_handler_timeout_cancels_and_watchdog_reports(self):
+    bot = TelegramBot("111:ff", "botname", handler_timeout=60)
+    bot.clock = Clock()
+    bot.on_handler_timeout_listener = MagicMock()
+    bot.on_stuck_handler_listener = MagicMock()
+    canceller = MagicMock()
+
+    def slow(message, bot):
+      return Deferred(canceller)
+
+    def hanging(message, bot):
+      return Deferred()
+
+    bot.register_message_handler(slow, commands=['slow'], timeout=5)
+    bot.register_message_handler(hanging, commands=['hang'])
+    bot.start_watchdog(threshold=20, interval=10)
+    bot.process_raw_updates([
+      {'update_id': 7, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': '/slow'}},
+      {'update_id': 8, 'message': {'message_id': 2, 'date': 0, 'chat': {'id': 2, 'type': 'private'}, 'text': '/hang'}},
+    ])
+
+    bot.clock.advance(5)
+    self.assertTrue(canceller.called)
+    message = bot.on_handler_timeout_listener.call_args[0][1]
+    self.assertEqual(message.update_id, 7)
+    self.assertEqual(len(bot._running_handlers), 1)
+
+    bot.clock.advance(15)
+    bot.on_stuck_handler_listener.assert_called_once_with(hanging, 8, 20)
+    bot.clock.advance(40)
+    self.assertEqual(bot.on_handler_timeout_listener.call_count, 2)
+    self.assertEqual(bot._running_handlers, {})
+    bot.close()
+
+  @patch('treq.request')
+  def test_cancelled_request_is_not_retried(self, request):
+    bot = TelegramBot("111:ff", "botname", max_retries=3)
+    bot.clock = Clock()
+    request.side_effect = lambda *args, **kwargs: Deferred()
+    errback = MagicMock()
+    d = bot.delete_message(1, 2)
+    d.addErrback(errback)
+    d.cancel()
+    bot.clock.advance(60)
+    self.assertEqual(request.call_count, 1)
+    self.assertTrue(errback.call_args[0][0].check(CancelledError))
+
+  @patch('treq.request')
+  def test_request_timeout_is_retried(self, request):
+    bot = TelegramBot("111:ff", "botname", max_retries=1, timeout=5)
+    bot.clock = Clock()
+    request.side_effect = lambda *args, **kwargs: Deferred()
+    errback = MagicMock()
+    bot.delete_message(1, 2).addErrback(errback)
+    bot.clock.advance(5)
+    bot.clock.advance(bot.retry_backoff)
+    self.assertEqual(request.call_count, 2)
+    bot.clock.advance(5)
+    self.assertTrue(errback.call_args[0][0].check(RequestTimeoutError))
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+from ttbot.types import Message, LazyMessage, User
+
+MESSAGE = {
+  'message_id': 2,
+  'from': {'id': 1, 'first_name': 'John'},
+  'chat': {'id': -10, 'title': 'group', 'type': 'group'},
+  'date': 1500000000,
+  'text': ' hello \n  world ',
+  'reply_to_message': {
+    'message_id': 1,
+    'chat': {'id': -10, 'title': 'group', 'type': 'group'},
+    'date': 1500000000,
+    'contact': {'phone_number': '123', 'first_name': 'Jane'},
+  },
+}
+
+
+class TestLazyMessage(TestCase):
+  def test_matches_message_attributes(self):
+    message = Message.de_json(MESSAGE)
+    lazy = LazyMessage.de_json(MESSAGE)
+
+    self.assertEqual(lazy.content_type, 'text')
+    self.assertEqual(lazy.chat.id, message.chat.id)
+    self.assertEqual(lazy.from_user.first_name, message.from_user.first_name)
+    self.assertEqual(lazy.text, message.text)
+    self.assertEqual(lazy.reply_to_message.content_type, 'contact')
+    self.assertEqual(lazy.reply_to_message.contact.phone_number, '123')
+    self.assertIsNone(lazy.reply_to_message.from_user)
+    self.assertFalse(hasattr(lazy, 'caption'))
+    self.assertFalse(hasattr(lazy.reply_to_message, 'reply_to_message'))
+    self.assertIs(lazy.chat, lazy.chat)
+
+
+class TestSlots(TestCase):
+  def test_types_have_no_instance_dict(self):
+    message = Message.de_json(MESSAGE)
+    self.assertFalse(hasattr(message, '__dict__'))
+    self.assertFalse(hasattr(message.reply_to_message.contact, '__dict__'))
+    self.assertFalse(hasattr(LazyMessage.de_json(MESSAGE), '__dict__'))
+    self.assertEqual(User(1, 'John').type, 'private')
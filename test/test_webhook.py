@@ -0,0 +1,65 @@
+import json
+from unittest import TestCase
+
+from mock import MagicMock
+from twisted.internet.defer import Deferred
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from ttbot.webhook import WebhookResource
+
+
+def _request(body, secret_token=None):
+  request = DummyRequest([b''])
+  request.method = b'POST'
+  request.content = MagicMock()
+  request.content.read.return_value = json.dumps(body)
+  if secret_token is not None:
+    request.requestHeaders.setRawHeaders(b'X-Telegram-Bot-Api-Secret-Token', [secret_token])
+  return request
+
+
+class TestWebhookResource(TestCase):
+  def test_rejects_wrong_secret_token(self):
+    bot = MagicMock()
+    resource = WebhookResource(bot, secret_token=b'secret')
+
+    request = _request({'update_id': 1}, secret_token=b'wrong')
+    resource.render_POST(request)
+
+    self.assertEqual(request.responseCode, 403)
+    missing = _request({'update_id': 1})
+    resource.render_POST(missing)
+    self.assertEqual(missing.responseCode, 403)
+    self.assertFalse(bot.process_webhook_update.called)
+
+  def test_responds_after_update_is_processed(self):
+    processed = Deferred()
+    bot = MagicMock()
+    bot.process_webhook_update.return_value = processed
+    resource = WebhookResource(bot, secret_token=u'secret', max_connections=1)
+
+    request = _request({'update_id': 1}, secret_token=b'secret')
+    self.assertEqual(resource.render_POST(request), NOT_DONE_YET)
+    bot.process_webhook_update.assert_called_once_with({'update_id': 1})
+
+    busy_request = _request({'update_id': 2}, secret_token=b'secret')
+    resource.render_POST(busy_request)
+    self.assertEqual(busy_request.responseCode, 503)
+
+    self.assertEqual(request.finished, 0)
+    processed.callback(None)
+    self.assertEqual(request.finished, 1)
+    self.assertEqual(resource.active_requests, 0)
+
+  def test_malformed_update_releases_its_slot(self):
+    bot = MagicMock()
+    bot.process_webhook_update.side_effect = KeyError('chat')
+    resource = WebhookResource(bot, max_connections=1)
+
+    for update_id in (1, 2):
+      request = _request({'update_id': update_id, 'message': {}})
+      self.assertEqual(resource.render_POST(request), NOT_DONE_YET)
+      self.assertEqual(request.finished, 1)
+    self.assertEqual(bot.process_webhook_update.call_count, 2)
+    self.assertEqual(resource.active_requests, 0)
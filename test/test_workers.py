@@ -0,0 +1,121 @@
+import json
+from unittest import TestCase
+
+from mock import MagicMock
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.internet.error import ProcessTerminated
+
+from ttbot import TelegramBot
+from ttbot.workers import WorkerPool, update_chat_id
+
+
+def _message_update(update_id, chat_id):
+  return {'update_id': update_id,
+          'message': {'message_id': update_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'},
+                      'from': {'id': chat_id, 'first_name': 'u'}, 'text': 'hi'}}
+
+
+class TestWorkerPool(TestCase):
+  def setUp(self):
+    self.clock = Clock()
+    self.processes = []
+
+    def spawn(protocol, executable, args, env, childFDs):
+      protocol.transport = MagicMock()
+      self.processes.append(protocol)
+      protocol.connectionMade()
+
+    self.pool = WorkerPool('app:make_bot', workers=2, max_in_flight=2, clock=self.clock, spawn=spawn)
+    self.pool.start()
+
+  def sent(self, protocol):
+    return [json.loads(call[0][1])['id'] for call in protocol.transport.writeToChild.call_args_list]
+
+  def test_shards_by_chat_and_limits_in_flight(self):
+    acked = []
+    for update_id, chat_id in enumerate([10, 11, 10, 10, 12]):
+      self.pool.dispatch(_message_update(update_id, chat_id)).addCallback(acked.append)
+    even, odd = self.processes
+    self.assertEqual(self.sent(even), [0, 2])
+    self.assertEqual(self.sent(odd), [1])
+    self.assertEqual(self.pool.queue_depth(), 5)
+
+    even.childDataReceived(3, b'{"ack": 0}\n{"ack"')
+    self.assertEqual(acked, [0])
+    self.assertEqual(self.sent(even), [0, 2, 3])
+    even.childDataReceived(3, b': 2}\n')
+    self.assertEqual(acked, [0, 2])
+    self.assertEqual(self.sent(even), [0, 2, 3, 4])
+
+  def test_respawns_and_resends_unacknowledged_updates(self):
+    acked = []
+    for update_id in range(3):
+      self.pool.dispatch(_message_update(update_id, 10)).addCallback(acked.append)
+    self.processes[0].processEnded(Failure(ProcessTerminated(exitCode=1)))
+    self.assertEqual(len(self.processes), 2)
+
+    self.clock.advance(1)
+    respawned = self.processes[2]
+    self.assertEqual(self.sent(respawned), [0, 1])
+    respawned.childDataReceived(3, b'{"ack": 0}\n{"ack": 1}\n')
+    respawned.childDataReceived(3, b'{"ack": 2}\n')
+    self.assertEqual(acked, [0, 1, 2])
+
+  def test_redelivered_update_finishes_with_the_first_copy(self):
+    acked = []
+    for _ in range(2):
+      self.pool.dispatch(_message_update(0, 10)).addCallback(acked.append)
+    self.assertEqual(self.sent(self.processes[0]), [0])
+    self.processes[0].childDataReceived(3, b'{"ack": 0}\n')
+    self.assertEqual(acked, [0, 0])
+    self.assertEqual(self.pool.workers[0].duplicates, {})
+
+  def test_ignores_stray_output(self):
+    acked = []
+    self.pool.dispatch(_message_update(0, 10)).addCallback(acked.append)
+    self.pool.dispatch(_message_update(2, 10)).addCallback(acked.append)
+    worker = self.processes[0]
+    worker.childDataReceived(1, b'{"ack": 0}\n')
+    worker.childDataReceived(3, b'debug output\n{"ack": 0}\n{"oops": 1}\n{"ack": 2}\n')
+    self.assertEqual(acked, [0, 2])
+
+  def test_full_backlog_holds_back_polling(self):
+    self.pool.max_backlog = 2
+    for update_id in range(4):
+      self.pool.dispatch(_message_update(update_id, 10))
+    self.assertTrue(self.pool.full())
+    capacity = self.pool.wait_for_capacity()
+    self.assertFalse(capacity.called)
+    self.processes[0].childDataReceived(3, b'{"ack": 0}\n')
+    self.assertTrue(capacity.called)
+
+  def test_stop_closes_worker_input(self):
+    d = self.pool.stop()
+    for process in self.processes:
+      process.transport.closeStdin.assert_called_once_with()
+      process.processEnded(Failure(ProcessTerminated(exitCode=0)))
+    self.assertTrue(d.called)
+    self.clock.advance(10)
+    self.assertEqual(len(self.processes), 2)
+
+  def test_update_chat_id(self):
+    self.assertEqual(update_chat_id({'update_id': 1, 'callback_query': {'from': {'id': 5}}}), 5)
+    self.assertEqual(update_chat_id({'update_id': 1, 'inline_query': {'from': {'id': 6}}}), 6)
+    self.assertEqual(update_chat_id({'update_id': 7}), 7)
+
+
+class TestBotDispatch(TestCase):
+  def test_offset_waits_for_worker_acknowledgement(self):
+    bot = TelegramBot('111:ff', 'test', update_dispatcher=WorkerPool('app:make_bot', workers=1, spawn=MagicMock()))
+    bot.process_raw_updates = MagicMock()
+    bot._poll_updates = MagicMock(side_effect=lambda *args: succeed([_message_update(5, 10)]))
+    bot.update_dispatcher.start()
+    bot.get_update_pipelined()
+    self.assertEqual(bot.last_update_id, -1)
+    self.assertFalse(bot.process_raw_updates.called)
+
+    worker = bot.update_dispatcher.workers[0]
+    worker.backlog[0][2].callback(5)
+    self.assertEqual(bot.last_update_id, 5)
@@ -1,16 +1,37 @@
 import json
 import collections
+import heapq
+import random
 import re
 from itertools import groupby
+from urlparse import urlparse
 
 import treq
 import telegram
-from cachetools import LRUCache
+from cachetools import LRUCache, TTLCache
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred, DeferredList
+from twisted.internet.error import ConnectError, ConnectingCancelledError, DNSLookupError
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.internet.defer import (inlineCallbacks, returnValue, Deferred, DeferredList, succeed, CancelledError,
+                                    TimeoutError)
 from twisted.logger import Logger
-
-from ttbot.types import Message, InlineQuery, ChosenInlineResult, JsonSerializable, CallbackQuery, File, ChannelPost
+from twisted.python.failure import Failure
+from twisted.web.client import (Agent, ContentDecoderAgent, GzipDecoder, HTTPConnectionPool, ResponseFailed,
+                                RequestTransmissionFailed)
+
+from ttbot.types import (Message, LazyMessage, InlineQuery, ChosenInlineResult, JsonSerializable, CallbackQuery, File,
+                         ChannelPost)
+from ttbot import codec
+from ttbot.broadcast import Broadcast
+from ttbot.dispatch import MessageHandlerIndex
+from ttbot.health import CLOSED, OPEN
+from ttbot.mediacache import MediaCache
+from ttbot.polling import AdaptivePoll
+from ttbot.queues import ChatQueues
+from ttbot.ratelimit import RATE_LIMITED_METHODS, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK
+from ttbot.state import MemoryStateStore
+from ttbot.streaming import MAX_DOWNLOAD_SIZE, FileTooLargeError, InputFile, stream_body, stream_body_to_path
+from ttbot.webhook import WebhookResource, webhook_site
 
 API_URL = r"https://api.telegram.org/"
 
@@ -18,6 +39,43 @@ log = Logger()
 
 PM_MARKDOWN = 'markdown'
 
+# methods that are safe to repeat when the outcome of a request is unknown
+IDEMPOTENT_METHODS = frozenset([
+  'getUpdates',
+  'getFile',
+  'getMe',
+  'setWebhook',
+  'deleteWebhook',
+  'deleteMessage',
+  'editMessageText',
+  'sendChatAction',
+])
+
+
+class RequestTimeoutError(Exception):
+  def __init__(self, method_name, timeout):
+    super(RequestTimeoutError, self).__init__("{0} got no response in {1} seconds".format(method_name, timeout))
+    self.method_name = method_name
+    self.timeout = timeout
+
+
+# the request never reached Telegram
+RETRY_ALWAYS_ERRORS = (ConnectError, DNSLookupError)
+
+# the request may have been processed; a CancelledError means the caller gave up and is never retried
+RETRY_IDEMPOTENT_ERRORS = (ResponseFailed, RequestTransmissionFailed, RequestTimeoutError)
+
+# "wrong file identifier/HTTP URL specified", "wrong remote file identifier specified", "invalid file_id"
+INVALID_FILE_ID_PATTERN = re.compile(r'file identifier|file_id|file reference', re.IGNORECASE)
+
+
+def _is_cancellation(failure):
+  if failure.check(CancelledError, ConnectingCancelledError):
+    return True
+  # the agent reports a request cancelled mid-flight as a ResponseFailed wrapping the CancelledError
+  return bool(failure.check(ResponseFailed, RequestTransmissionFailed)) \
+      and any(reason.check(CancelledError, ConnectingCancelledError) for reason in failure.value.reasons)
+
 
 def is_string(var):
   return isinstance(var, basestring)
@@ -44,24 +102,37 @@ def _convert_utf8(data):
     return data
 
 
+def _parse_error(resp, method_name, result_content):
+  try:
+    result_json = codec.loads(result_content)
+    error_code = result_json['error_code']
+    description = result_json['description']
+  except:
+    msg = 'The server returned HTTP {0} {1} ({2})'.format(resp.code, resp.phrase,
+                                                          result_content.decode('utf-8', 'replace'))
+    return ApiException(msg, method_name, resp, error_code=resp.code)
+
+  msg = 'Error code: {0} Description: {1}'.format(error_code, description)
+  return ApiException(msg, method_name, resp,
+                      error_code=error_code, description=description, parameters=result_json.get('parameters'))
+
+
 @inlineCallbacks
 def _check_response(resp, method_name):
-  if resp.code != 200:
-    error_text = yield resp.text()
-    msg = 'The server returned HTTP {0} {1} ({2})'.format(resp.code, resp.phrase, error_text)
-    raise ApiException(msg, method_name, resp)
+  result_content = yield resp.content()
 
-  result_text = yield resp.text()
+  if resp.code != 200:
+    raise _parse_error(resp, method_name, result_content)
 
   try:
-    result_json = json.loads(result_text)
+    result_json = codec.loads(result_content)
   except:
-    msg = 'The server returned an invalid JSON response. Response body:\n[{0}]'.format(result_text)
+    msg = 'The server returned an invalid JSON response. Response body:\n[{0}]'.format(
+      result_content.decode('utf-8', 'replace'))
     raise ApiException(msg, method_name, resp)
 
   if not result_json['ok']:
-    msg = 'Error code: {0} Description: {1}'.format(result_json['error_code'], result_json['description'])
-    raise ApiException(msg, method_name, resp)
+    raise _parse_error(resp, method_name, result_content)
 
   returnValue(result_json)
 
@@ -70,7 +141,17 @@ def _convert_markup(reply_markup):
   if isinstance(reply_markup, JsonSerializable):
     return reply_markup.to_json()
   elif isinstance(reply_markup, dict):
-    return json.dumps(reply_markup)
+    # ASCII output, so unicode and UTF-8 encoded str can be mixed on Python 2
+    return codec.dumps(reply_markup, ensure_ascii=True)
+
+
+def serialize_inline_results(results):
+  return codec.dumps([result.to_dict() if isinstance(result, telegram.InlineQueryResult) else result
+                      for result in results], ensure_ascii=True)
+
+
+def _handler_name(handler):
+  return getattr(handler, '__name__', type(handler).__name__)
 
 
 def _map_function_to_deferred(f, *args, **kwargs):
@@ -84,18 +165,59 @@ def _map_function_to_deferred(f, *args, **kwargs):
 
 
 class TelegramBot(object):
-  def __init__(self, token, name, skip_offset=False, allowed_updates=None, agent=None, timeout=None):
+  def __init__(self, token, name, skip_offset=False, allowed_updates=None, agent=None, timeout=None,
+               chat_queues=None, rate_limiter=None, max_retries=0, retry_backoff=0.5, retry_backoff_max=30,
+               pool=None, pool_size=10, pool_idle_timeout=240, gzip=False, lazy_messages=False,
+               media_cache=None, file_cache_size=10000, file_cache_ttl=50 * 60, metrics=None, poll_pool=None,
+               poll_scheduler=None, update_dispatcher=None, journal=None, message_subscribers=None,
+               message_next_handlers=None, handler_timeout=None, circuit_breaker=None, poll_tuner=None):
     self.id = int(token.split(':')[0])
     self.name = name
     self.token = token
+    self.pool = None
+    self.poll_pool = None
+    # pools passed in may be shared with other bots, close() leaves them to their owner
+    self._owned_pools = []
+    self.closed = False
+    if agent is None:
+      if pool is None:
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = pool_size
+        pool.cachedConnectionTimeout = pool_idle_timeout
+        self._owned_pools.append(pool)
+      if poll_pool is None:
+        # the long poll gets its own connection, so it never waits for or holds up a send
+        poll_pool = HTTPConnectionPool(reactor, persistent=True)
+        poll_pool.maxPersistentPerHost = 1
+        poll_pool.cachedConnectionTimeout = pool_idle_timeout
+        self._owned_pools.append(poll_pool)
+      self.poll_pool = poll_pool
+      self.pool = pool
+      agent = Agent(reactor, pool=self.pool)
+      poll_agent = Agent(reactor, pool=self.poll_pool)
+      if gzip:
+        agent = ContentDecoderAgent(agent, [(b'gzip', GzipDecoder)])
+        poll_agent = ContentDecoderAgent(poll_agent, [(b'gzip', GzipDecoder)])
+    else:
+      poll_agent = agent
     self.agent = agent
+    self.poll_agent = poll_agent
     self.last_update_id = -2 if skip_offset else -1
     self.update_prehandlers = []
     self.message_handlers = []
-    self.message_subscribers = LRUCache(maxsize=10000)
+    self._message_handler_index = MessageHandlerIndex()
+    if message_subscribers is None:
+      message_subscribers = MemoryStateStore(maxsize=10000, on_evict=self._on_conversation_evicted)
+    self.message_subscribers = message_subscribers
     self.message_prehandlers = []
-    self.message_next_handlers = LRUCache(maxsize=1000)
+    if message_next_handlers is None:
+      message_next_handlers = MemoryStateStore(maxsize=1000, on_evict=self._on_conversation_evicted)
+    self.message_next_handlers = message_next_handlers
     self.retry_update = 0
+    self.poll_failures = 0
+    self.last_poll = None
+    self.circuit_breaker = circuit_breaker
+    self.poll_tuner = poll_tuner
     self.allowed_updates = allowed_updates
     self.running = False
     self.inline_query_handler = None
@@ -104,15 +226,59 @@ class TelegramBot(object):
     self.channel_post_handler = None
     self.on_updated_listener = None
     self.on_api_request_listener = None
+    self.on_handler_timeout_listener = None
+    self.on_stuck_handler_listener = None
+    self.handler_timeout = handler_timeout
+    self.handler_timeouts = {}
+    self._running_handlers = {}
+    self._watchdog = None
     self.botan = None
     self.timeout = timeout
+    self.chat_queues = chat_queues
+    self.message_class = LazyMessage if lazy_messages else Message
+    self.rate_limiter = rate_limiter
+    self.media_cache = media_cache
+    # download links stay valid for about an hour
+    self.file_cache = TTLCache(maxsize=file_cache_size, ttl=file_cache_ttl)
+    self._file_requests = {}
+    self.metrics = metrics
+    self.poll_scheduler = poll_scheduler
+    self.update_dispatcher = update_dispatcher
+    self.journal = journal
+    if metrics is not None:
+      self._register_gauges(metrics)
+    self.max_retries = max_retries
+    self.retry_backoff = retry_backoff
+    self.retry_backoff_max = retry_backoff_max
+    self.chat_migrations = LRUCache(maxsize=10000)
+    self.clock = reactor
     self._noisy = False
+    self._pending_updates = {}
+    self._pending_update_ids = []
+    # with a journal, pipelined polling asks for updates past the ones in flight, last_update_id only
+    # moves once they're done
+    self._fetched_update_id = -2
+    self._update_stalled = False
+    self._update_capacity_waiters = []
+
+  def _register_gauges(self, metrics):
+    labels = (self.name,)
+    metrics.updates_in_flight.set_function(lambda: len(self._pending_updates), labels)
+    metrics.chat_queue_depth.set_function(lambda: len(self.chat_queues) if self.chat_queues is not None else 0, labels)
+    metrics.rate_limiter_queue_depth.set_function(
+      lambda: self.rate_limiter.queue_depth() if self.rate_limiter is not None else 0, labels)
 
   def method_url(self, method):
     return API_URL + 'bot' + self.token + '/' + method
 
-  def start_update(self, default_delay=0, **kwargs):
+  def start_update(self, default_delay=0, pipelined=False, max_in_flight_updates=500, backoff=1, backoff_max=60,
+                   adaptive=False, **kwargs):
     self.running = True
+    if pipelined and self.chat_queues is None:
+      # batches overlap, so per-chat order has to be kept across them
+      self.chat_queues = ChatQueues()
+    if adaptive and self.poll_tuner is None:
+      self.poll_tuner = AdaptivePoll(limit=kwargs.get('limit', 100), timeout=kwargs.get('telegram_timeout', 10))
 
     @inlineCallbacks
     def update_bot():
@@ -120,30 +286,224 @@ class TelegramBot(object):
         return
 
       try:
-        yield self.get_update(**kwargs)
-
+        poll_kwargs = kwargs
+        if self.poll_tuner is not None:
+          poll_kwargs = dict(kwargs, telegram_timeout=self.poll_tuner.timeout, limit=self.poll_tuner.limit)
+        if self.update_dispatcher is not None:
+          yield self.update_dispatcher.wait_for_capacity()
+        if pipelined:
+          yield self._wait_for_update_capacity(max_in_flight_updates)
+          yield self.get_update_pipelined(**poll_kwargs)
+        else:
+          yield self.get_update(**poll_kwargs)
+
+        self.poll_failures = 0
+        self.last_poll = self.clock.seconds()
         self.retry_update = default_delay
-      except:
-        log.failure("Couldn't get updates. Delaying for {delay} seconds", delay=self.retry_update)
-        self.retry_update = min(self.retry_update + 3, 20)
+      except Exception as e:
+        self.poll_failures += 1
+        if self.poll_tuner is not None:
+          self.poll_tuner.failed()
+        self.retry_update = self._poll_retry_delay(e, backoff, backoff_max)
+        log.failure("Couldn't get updates. Delaying for {delay:.1f} seconds", delay=self.retry_update)
       reactor.callLater(self.retry_update, update_bot)
 
-    reactor.callWhenRunning(update_bot)
+    def start():
+      if self.journal is None:
+        return update_bot()
+      return self._replay_journal().addCallback(lambda _: update_bot())
+
+    reactor.callWhenRunning(start)
+
+  def _poll_retry_delay(self, error, backoff, backoff_max):
+    # exponential with jitter, so bots that failed together don't come back together
+    cap = min(backoff_max, backoff * 2 ** (self.poll_failures - 1))
+    delay = cap / 2.0 + random.uniform(0, cap / 2.0)
+    retry_after = getattr(error, 'retry_after', None)
+    return max(delay, retry_after) if retry_after else delay
+
+  def health(self, stale_after=120):
+    now = self.clock.seconds()
+    last_poll_age = now - self.last_poll if self.last_poll is not None else None
+    circuit = self.circuit_breaker.state if self.circuit_breaker is not None else CLOSED
+    polling = not self.running or last_poll_age is not None and last_poll_age <= stale_after
+    return {
+      'healthy': circuit != OPEN and polling,
+      'running': self.running,
+      'circuit': circuit,
+      'poll_failures': self.poll_failures,
+      'last_poll_age': last_poll_age,
+      'poll_limit': self.poll_tuner.limit if self.poll_tuner is not None else None,
+      'poll_timeout': self.poll_tuner.timeout if self.poll_tuner is not None else None,
+      'updates_in_flight': len(self._pending_updates),
+    }
 
   def stop_update(self):
     self.running = False
 
+  def close(self):
+    self.stop_watchdog()
+    if self.closed:
+      return succeed(None)
+    self.closed = True
+    if self.journal is not None:
+      self.journal.close()
+    self.message_subscribers.close()
+    self.message_next_handlers.close()
+    return DeferredList([pool.closeCachedConnections() for pool in self._owned_pools])
+
   @inlineCallbacks
   def get_update(self, telegram_timeout=10, timeout=None, limit=100):
-    payload = {'timeout': telegram_timeout, 'offset': self.last_update_id + 1, 'limit': limit}
-    if self.allowed_updates:
-      payload['allowed_updates'] = self.allowed_updates
-    updates = yield self._request('getUpdates', params=payload, timeout=timeout)
-
-    if self.on_updated_listener:
-      self.on_updated_listener(updates)
+    updates = yield self._poll_updates(telegram_timeout, timeout, limit)
 
     max_update_id = -1
+    for update in updates:
+      if update['update_id'] > max_update_id:
+        max_update_id = update['update_id']
+
+    started = self.clock.seconds()
+    yield self._handle_updates(updates)
+    self._observe_processing(None, started)
+
+    self.last_update_id = max_update_id
+    if self.journal is not None and max_update_id >= 0:
+      self.journal.commit(max_update_id)
+
+  @inlineCallbacks
+  def get_update_pipelined(self, telegram_timeout=10, timeout=None, limit=100):
+    # With a journal, polls past the updates still in flight: the journal is synced before the poll
+    # confirms them to Telegram, so a crash replays them. Without one, polls from the committed offset,
+    # updates still in flight are delivered again and skipped here, and Telegram only forgets an
+    # update once everything up to it is done.
+    if self.journal is not None:
+      offset = max(self.last_update_id, self._fetched_update_id) + 1
+    else:
+      offset = self.last_update_id + 1
+    updates = yield self._poll_updates(telegram_timeout, timeout, limit, offset)
+
+    new_updates = [update for update in updates
+                   if update['update_id'] > self.last_update_id
+                   and update['update_id'] not in self._pending_updates]
+    if not new_updates:
+      # everything returned is already in flight, wait for progress instead of spinning
+      self._update_stalled = self.journal is None and bool(self._pending_updates)
+      return
+
+    update_ids = [update['update_id'] for update in new_updates]
+    for update_id in update_ids:
+      self._pending_updates[update_id] = False
+      heapq.heappush(self._pending_update_ids, update_id)
+    try:
+      d = self._handle_updates(new_updates)
+    except Exception:
+      # nothing was started, so the batch is fetched again by the next poll
+      for update_id in update_ids:
+        del self._pending_updates[update_id]
+      self._pending_update_ids = [update_id for update_id in self._pending_update_ids
+                                  if update_id in self._pending_updates]
+      heapq.heapify(self._pending_update_ids)
+      raise
+    self._fetched_update_id = max(self._fetched_update_id, max(update_ids))
+    d.addBoth(self._observe_processing, self.clock.seconds())
+    d.addBoth(self._complete_updates, update_ids)
+
+  def _poll_updates(self, telegram_timeout, timeout, limit, offset=None):
+    if offset is None:
+      offset = self.last_update_id + 1
+
+    def _get_updates(telegram_timeout):
+      if self.journal is not None:
+        # the new offset confirms updates to Telegram, so whatever the journal knows must be on disk first
+        self.journal.sync()
+      payload = {'timeout': telegram_timeout, 'offset': offset, 'limit': limit}
+      if self.allowed_updates:
+        payload['allowed_updates'] = self.allowed_updates
+      request_timeout = timeout
+      if self.poll_tuner is not None and (timeout or self.timeout) is not None:
+        # the tuner may lengthen the long poll past the configured request timeout
+        request_timeout = max(timeout or self.timeout, telegram_timeout + 5)
+      return self._request('getUpdates', params=payload, timeout=request_timeout)
+
+    if self.poll_scheduler is None:
+      d = _get_updates(telegram_timeout)
+    else:
+      d = self.poll_scheduler.poll(_get_updates, telegram_timeout)
+
+    def _notify(updates):
+      if self.poll_tuner is not None:
+        self.poll_tuner.observe_batch(len(updates))
+      if self.metrics is not None:
+        self.metrics.update_batch_size.observe(len(updates), (self.name,))
+      if self.on_updated_listener:
+        self.on_updated_listener(updates)
+      return updates
+
+    return d.addCallback(_notify)
+
+  def _observe_processing(self, result, started):
+    if self.poll_tuner is not None:
+      self.poll_tuner.observe_processing(self.clock.seconds() - started)
+    return result
+
+  def _wait_for_update_capacity(self, max_in_flight_updates):
+    if len(self._pending_updates) < max_in_flight_updates and not self._update_stalled:
+      return succeed(None)
+    d = Deferred()
+    self._update_capacity_waiters.append(d)
+    return d
+
+  def _complete_updates(self, result, update_ids):
+    for update_id in update_ids:
+      self._pending_updates[update_id] = True
+    while self._pending_update_ids and self._pending_updates[self._pending_update_ids[0]]:
+      update_id = heapq.heappop(self._pending_update_ids)
+      del self._pending_updates[update_id]
+      self.last_update_id = max(self.last_update_id, update_id)
+    if self.journal is not None and self.last_update_id >= 0:
+      self.journal.commit(self.last_update_id)
+
+    self._update_stalled = False
+    waiters, self._update_capacity_waiters = self._update_capacity_waiters, []
+    for d in waiters:
+      d.callback(None)
+    return result
+
+  def _handle_updates(self, updates):
+    if self.journal is None:
+      return self.dispatch_raw_updates(updates)
+    updates = self.journal.record(updates)
+    update_ids = [update['update_id'] for update in updates]
+    return self.dispatch_raw_updates(updates).addBoth(self._journal_completed, update_ids)
+
+  def _journal_completed(self, result, update_ids):
+    self.journal.complete(update_ids)
+    return result
+
+  def _replay_journal(self, commit=True):
+    if self.journal.offset is not None:
+      self.last_update_id = max(self.last_update_id, self.journal.offset)
+    updates = self.journal.pending_updates()
+    if updates:
+      log.info("Replaying {count} journaled updates", count=len(updates))
+    update_ids = [update['update_id'] for update in updates]
+    d = self.dispatch_raw_updates(updates).addBoth(self._journal_completed, update_ids)
+
+    def _replayed(result):
+      # everything journaled has now been handled, including updates completed before the restart
+      last_journaled_id = self.journal.last_journaled_id
+      if commit and last_journaled_id is not None and last_journaled_id > self.last_update_id:
+        self.last_update_id = last_journaled_id
+        self.journal.commit(last_journaled_id)
+      return result
+
+    return d.addCallback(_replayed)
+
+  def dispatch_raw_updates(self, updates):
+    if self.update_dispatcher is not None:
+      return self.update_dispatcher.dispatch_updates(updates)
+    return self.process_raw_updates(updates)
+
+  def process_raw_updates(self, updates):
     inline_queries = []
     chosen_inline_results = []
     callback_queries = []
@@ -156,37 +516,38 @@ class TelegramBot(object):
       self._notify_update_prehandlers(update)
 
       if 'inline_query' in update:
-        inline_queries.append(InlineQuery.de_json(update['inline_query']))
+        parsed = InlineQuery.de_json(update['inline_query'])
+        inline_queries.append(parsed)
       elif 'chosen_inline_result' in update:
-        chosen_inline_results.append(ChosenInlineResult.de_json(update['chosen_inline_result']))
+        parsed = ChosenInlineResult.de_json(update['chosen_inline_result'])
+        chosen_inline_results.append(parsed)
       elif 'callback_query' in update:
-        callback_queries.append(CallbackQuery.de_json(update['callback_query']))
+        parsed = CallbackQuery.de_json(update['callback_query'])
+        callback_queries.append(parsed)
       elif 'channel_post' in update:
-        channel_posts.append(ChannelPost(Message.de_json(update['channel_post'])))
+        parsed = ChannelPost(self.message_class.de_json(update['channel_post']))
+        channel_posts.append(parsed)
       elif 'message' in update:
-        msg = Message.de_json(update['message'])
-        msg.bot_name = self.name  # FIXME: a hack
-        messages.append(msg)
+        parsed = self.message_class.de_json(update['message'])
+        parsed.bot_name = self.name  # FIXME: a hack
+        messages.append(parsed)
       else:
         log.debug("Unsupported update type: {update}",
                   update=json.dumps(update, skipkeys=True, ensure_ascii=False, default=lambda o: o.__dict__))
+        continue
+      parsed.update_id = update['update_id']
 
-      if update['update_id'] > max_update_id:
-        max_update_id = update['update_id']
-
-    yield self.process_updates(inline_queries, chosen_inline_results, callback_queries, channel_posts, messages)
-
-    self.last_update_id = max_update_id
+    return self.process_updates(inline_queries, chosen_inline_results, callback_queries, channel_posts, messages)
 
   def process_updates(self, inline_queries, chosen_inline_results, callback_queries, channel_posts, messages):
     return DeferredList(
       [
-        self.process_updates_parallel_with_handler(self.inline_query_handler, inline_queries, self),
-        self.process_updates_parallel_with_handler(self.chosen_inline_result_handler, chosen_inline_results, self),
+        self._run_handler_in_parallel(self.inline_query_handler, inline_queries, self),
+        self._run_handler_in_parallel(self.chosen_inline_result_handler, chosen_inline_results, self),
 
         # TODO: maybe callback_queries and channel_posts need to be processed one by one (is order important?)
-        self.process_updates_parallel_with_handler(self.callback_query_handler, callback_queries, self),
-        self.process_updates_parallel_with_handler(self.channel_post_handler, channel_posts, self),
+        self._run_handler_in_parallel(self.callback_query_handler, callback_queries, self),
+        self._run_handler_in_parallel(self.channel_post_handler, channel_posts, self),
 
         self.process_messages(messages)
       ]
@@ -201,21 +562,93 @@ class TelegramBot(object):
       d.callback(None)
       return d
 
+  def _run_handler_in_parallel(self, handler, updates, *args, **kwargs):
+    # process_updates_parallel_with_handler with timeouts, the watchdog and metrics
+    if handler is not None and updates:
+      return DeferredList([self._run_handler(handler, update, *args, **kwargs) for update in updates])
+    else:
+      d = Deferred()
+      d.callback(None)
+      return d
+
   def process_message(self, message):
     # synchronously notify prehandlers
     self._notify_message_prehandlers(message)
 
     message_subscriber_handler_function = self._find_message_subscriber_handler_function(message)
     if message_subscriber_handler_function is not None:
-      return _map_function_to_deferred(message_subscriber_handler_function, message, self)
+      return self._run_handler(message_subscriber_handler_function, message, self)
 
     message_next_handler = self._find_message_next_handler(message)
     if message_next_handler is not None:
-      return _map_function_to_deferred(message_next_handler, message, self)
+      return self._run_handler(message_next_handler, message, self)
 
     command_handler_function = self._find_command_handler_function(message)
     if command_handler_function is not None:
-      return _map_function_to_deferred(command_handler_function, message, self)
+      return self._run_handler(command_handler_function, message, self)
+
+  def _run_handler(self, handler, update, *args, **kwargs):
+    started = self.clock.seconds()
+    try:
+      d = _map_function_to_deferred(handler, update, *args, **kwargs)
+    except:
+      if self.metrics is not None:
+        self._observe_handler(Failure(), handler, started)
+      raise
+
+    timeout = None
+    if not d.called:
+      self._running_handlers[d] = (handler, getattr(update, 'update_id', None), started)
+      d.addBoth(self._handler_finished, d)
+      timeout = self.handler_timeouts.get(handler, self.handler_timeout)
+      if timeout is not None:
+        # cancels the handler's Deferred, which fails with TimeoutError
+        d.addTimeout(timeout, self.clock)
+    if self.metrics is not None:
+      d.addBoth(self._observe_handler, handler, started)
+    if timeout is not None:
+      d.addErrback(self._on_handler_timeout, handler, update, timeout)
+    return d
+
+  def _handler_finished(self, result, d):
+    self._running_handlers.pop(d, None)
+    return result
+
+  def _observe_handler(self, result, handler, started):
+    labels = (self.name, _handler_name(handler))
+    self.metrics.handler_duration.observe(self.clock.seconds() - started, labels)
+    if isinstance(result, Failure):
+      self.metrics.handler_errors.inc(labels)
+    return result
+
+  def _on_handler_timeout(self, failure, handler, update, timeout):
+    failure.trap(TimeoutError)
+    log.warn("Handler {handler} timed out after {timeout} seconds on update {update_id}",
+             handler=_handler_name(handler), timeout=timeout, update_id=getattr(update, 'update_id', None))
+    if self.on_handler_timeout_listener:
+      self.on_handler_timeout_listener(handler, update)
+
+  def start_watchdog(self, threshold=30, interval=None):
+    self.stop_watchdog()
+    self._watchdog = LoopingCall(self._check_stuck_handlers, threshold)
+    self._watchdog.clock = self.clock
+    self._watchdog.start(interval or threshold / 2.0, now=False)
+
+  def stop_watchdog(self):
+    if self._watchdog is not None:
+      self._watchdog.stop()
+      self._watchdog = None
+
+  def _check_stuck_handlers(self, threshold):
+    now = self.clock.seconds()
+    for handler, update_id, started in self._running_handlers.values():
+      elapsed = now - started
+      if elapsed < threshold:
+        continue
+      log.warn("Handler {handler} is still running on update {update_id} after {elapsed:.0f} seconds",
+               handler=_handler_name(handler), update_id=update_id, elapsed=elapsed)
+      if self.on_stuck_handler_listener:
+        self.on_stuck_handler_listener(handler, update_id, elapsed)
 
   @inlineCallbacks
   def process_messages_in_order(self, messages):
@@ -223,7 +656,11 @@ class TelegramBot(object):
       yield self.process_message(message)
 
   def process_messages(self, messages):
-    if messages:
+    if messages and self.chat_queues is not None:
+      # a chat with a full queue holds the batch back, so its offset isn't committed before the message runs
+      return DeferredList([self.chat_queues.put(message.chat.id, self.process_message, message)
+                           for message in messages])
+    elif messages:
       return DeferredList([self.process_messages_in_order(messages_group[1])
                            for messages_group
                            in groupby(sorted(messages, key=lambda m: m.chat.id), key=lambda m: m.chat.id)])
@@ -249,10 +686,13 @@ class TelegramBot(object):
       handler(message, self)
 
   def _find_command_handler_function(self, message):
-    for message_handler in self.message_handlers:
-      if self._test_message_handler(message_handler, message):
-        return message_handler['function']
-    return None
+    if self._message_handler_index.size != len(self.message_handlers):
+      # message_handlers was changed directly, not through register_message_handler
+      self._message_handler_index = MessageHandlerIndex()
+      for message_handler in self.message_handlers:
+        self._message_handler_index.add(message_handler)
+    command = extract_command(message.text) if message.content_type == 'text' else None
+    return self._message_handler_index.find(message, command)
 
   def _find_message_subscriber_handler_function(self, message):
     if not hasattr(message, 'reply_to_message'):
@@ -262,7 +702,13 @@ class TelegramBot(object):
   def _find_message_next_handler(self, message):
     return self.message_next_handlers.pop(message.chat.id, None)
 
-  def register_message_handler(self, fn, commands=None, regexp=None, func=None, content_types=None):
+  def register_message_handler(self, fn, commands=None, regexp=None, func=None, content_types=None, timeout=None,
+                               offload=None):
+    if offload is not None:
+      # a ThreadOffload or ProcessOffload from ttbot.offload
+      fn = offload.handler(fn)
+    if timeout is not None:
+      self.handler_timeouts[fn] = timeout
     if not content_types:
       content_types = ['text']
     func_dict = {'function': fn, 'content_types': content_types}
@@ -273,10 +719,11 @@ class TelegramBot(object):
     if commands:
       func_dict['commands'] = commands if 'text' in content_types else None
     self.message_handlers.append(func_dict)
+    self._message_handler_index.add(func_dict)
 
-  def message_handler(self, commands=None, regexp=None, func=None, content_types=None):
+  def message_handler(self, commands=None, regexp=None, func=None, content_types=None, timeout=None, offload=None):
     def decorator(fn):
-      self.register_message_handler(fn, commands, regexp, func, content_types)
+      self.register_message_handler(fn, commands, regexp, func, content_types, timeout, offload)
       return fn
 
     return decorator
@@ -307,7 +754,8 @@ class TelegramBot(object):
                    disable_web_page_preview=None,
                    reply_to_message_id=None,
                    reply_markup=None,
-                   parse_mode=None):
+                   parse_mode=None,
+                   priority=PRIORITY_NORMAL):
     method = r'sendMessage'
 
     payload = {'chat_id': str(chat_id), 'text': text}
@@ -319,7 +767,7 @@ class TelegramBot(object):
       payload['reply_markup'] = _convert_markup(reply_markup)
     if parse_mode:
       payload['parse_mode'] = parse_mode
-    request = yield self._request(method, 'POST', params=payload)
+    request = yield self._request(method, 'POST', params=payload, priority=priority)
     returnValue(Message.de_json(request))
 
   def answer_to_inline_query(self, query_id, results,
@@ -327,15 +775,10 @@ class TelegramBot(object):
                              next_offset='',
                              switch_pm_text=None,
                              switch_pm_parameter=None):
-    def _map_result(result):
-      if isinstance(result, telegram.InlineQueryResult):
-        return result.to_dict()
-      else:
-        return result
-
     payload = {
       'inline_query_id': str(query_id),
-      'results': json.dumps([_map_result(res) for res in results]),
+      # already serialized results are sent as they are
+      'results': results if isinstance(results, basestring) else serialize_inline_results(results),
       'is_personal': personal,
       'next_offset': next_offset
     }
@@ -349,38 +792,62 @@ class TelegramBot(object):
   def edit_message_text(self, chat_id, message_id, text,
                         parse_mode=None,
                         disable_web_page_preview=None,
-                        reply_markup=None):
+                        reply_markup=None,
+                        priority=PRIORITY_NORMAL):
     method = r'editMessageText'
 
     payload = {'chat_id': str(chat_id), 'message_id': str(message_id), 'text': text}
     if disable_web_page_preview:
       payload['disable_web_page_preview'] = disable_web_page_preview
     if reply_markup:
-      if isinstance(reply_markup, JsonSerializable):
-        payload['reply_markup'] = reply_markup.to_json()
-      elif isinstance(reply_markup, dict):
-        payload['reply_markup'] = json.dumps(reply_markup)
+      payload['reply_markup'] = _convert_markup(reply_markup)
     if parse_mode:
       payload['parse_mode'] = parse_mode
-    request = yield self._request(method, 'POST', params=payload)
+    request = yield self._request(method, 'POST', params=payload, priority=priority)
     returnValue(Message.de_json(request))
 
-  def set_webhook(self, url, certificate, max_connections=None):
+  def set_webhook(self, url, certificate=None, max_connections=None, secret_token=None):
     method = r'setWebhook'
 
     payload = {'url': url}
     files = None
-    if not is_string(certificate):
-      files = {'certificate': ('cert', certificate)}
-    else:
-      payload['certificate'] = certificate
+    if certificate is not None:
+      if not is_string(certificate):
+        files = {'certificate': ('cert', certificate)}
+      else:
+        payload['certificate'] = certificate
     if max_connections:
       payload['max_connections'] = max_connections
+    if secret_token:
+      payload['secret_token'] = secret_token
     if self.allowed_updates:
       payload['allowed_updates'] = self.allowed_updates
 
     return self._make_request(method, 'POST', params=payload, files=files)
 
+  @inlineCallbacks
+  def start_webhook(self, url, port, secret_token=None, certificate=None, max_connections=40, interface=''):
+    if self.journal is not None:
+      # webhook updates come in any order, there is no offset to move past them
+      yield self._replay_journal(commit=False)
+    yield self.set_webhook(url, certificate, max_connections=max_connections, secret_token=secret_token)
+    site = webhook_site(self, urlparse(url).path, secret_token=secret_token, max_connections=max_connections)
+    returnValue(reactor.listenTCP(port, site, interface=interface))
+
+  def process_webhook_update(self, update):
+    if self.on_updated_listener:
+      self.on_updated_listener([update])
+    d = self._handle_updates([update])
+    if self.journal is not None:
+      d.addBoth(self._journal_webhook_update)
+    return d
+
+  def _journal_webhook_update(self, result):
+    # make the update durable before Telegram gets its response
+    self.journal.forget_completed()
+    self.journal.sync()
+    return result
+
   def delete_webhook(self):
     method = r'deleteWebhook'
 
@@ -408,19 +875,70 @@ class TelegramBot(object):
     request = yield self._request(method, 'POST', params=payload)
     returnValue(request)
 
-  @inlineCallbacks
   def get_file(self, file_id):
     method = r'getFile'
 
-    payload = {'file_id': str(file_id)}
+    file_id = str(file_id)
+    file = self.file_cache.get(file_id)
+    if file is not None:
+      return succeed(file)
 
-    request = yield self._request(method, 'POST', params=payload)
-    returnValue(File.de_json(request))
+    # concurrent lookups of the same file share one request
+    waiters = self._file_requests.get(file_id)
+    if waiters is not None:
+      d = Deferred()
+      waiters.append(d)
+      return d
+    waiters = self._file_requests[file_id] = []
+
+    def _parse(result):
+      file = File.de_json(result)
+      self.file_cache[file_id] = file
+      return file
+
+    def _settle(result):
+      # also runs when _parse raises, so waiters are never left hanging
+      for d in self._file_requests.pop(file_id):
+        if isinstance(result, Failure):
+          d.errback(result)
+        else:
+          d.callback(result)
+      return result
+
+    payload = {'file_id': file_id}
+    return self._request(method, 'POST', params=payload).addCallback(_parse).addBoth(_settle)
 
   def get_file_url(self, file):
+    if not isinstance(file, File):
+      # a file_id, the path comes from an earlier get_file
+      cached = self.file_cache.get(str(file))
+      if cached is None:
+        raise ValueError("File {0} is not cached, get_file() it or pass the File".format(file))
+      file = cached
     return "https://api.telegram.org/file/bot%s/%s" % (self.token, file.path)
 
   @inlineCallbacks
+  def download_file(self, file_or_id, consumer_or_path, max_size=MAX_DOWNLOAD_SIZE, timeout=None):
+    if isinstance(file_or_id, File):
+      file = file_or_id
+    else:
+      file = yield self.get_file(file_or_id)
+    if max_size and file.size > max_size:
+      raise FileTooLargeError(file.size, max_size)
+
+    if timeout is None:
+      timeout = self.timeout
+    resp = yield treq.get(self.get_file_url(file), agent=self.agent, timeout=timeout, unbuffered=True)
+    if resp.code != 200:
+      result_content = yield resp.content()
+      raise _parse_error(resp, 'getFile', result_content)
+
+    if is_string(consumer_or_path):
+      size = yield stream_body_to_path(resp, consumer_or_path, max_size)
+    else:
+      size = yield stream_body(resp, consumer_or_path, max_size)
+    returnValue(size)
+
   def send_audio(self, chat_id, audio,
                  filename='audio',
                  duration=None,
@@ -429,21 +947,69 @@ class TelegramBot(object):
                  caption=None,
                  reply_to_message_id=None,
                  reply_markup=None,
-                 timeout=None):
-    method = r'sendAudio'
+                 timeout=None,
+                 priority=PRIORITY_NORMAL,
+                 progress=None,
+                 cache_key=None):
+    return self._send_media('sendAudio', 'audio', chat_id, audio, filename,
+                            params={'duration': duration, 'performer': performer, 'title': title},
+                            caption=caption, reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
+                            timeout=timeout, priority=priority, progress=progress, cache_key=cache_key)
+
+  def send_voice(self, chat_id, voice,
+                 filename='voice',
+                 duration=None,
+                 caption=None,
+                 reply_to_message_id=None,
+                 reply_markup=None,
+                 timeout=None,
+                 priority=PRIORITY_NORMAL,
+                 progress=None,
+                 cache_key=None):
+    return self._send_media('sendVoice', 'voice', chat_id, voice, filename,
+                            params={'duration': duration},
+                            caption=caption, reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
+                            timeout=timeout, priority=priority, progress=progress, cache_key=cache_key)
+
+  def send_document(self, chat_id, document,
+                    filename=None,
+                    caption=None,
+                    reply_to_message_id=None,
+                    reply_markup=None,
+                    timeout=None,
+                    priority=PRIORITY_NORMAL,
+                    progress=None,
+                    cache_key=None):
+    return self._send_media('sendDocument', 'document', chat_id, document, filename,
+                            caption=caption, reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
+                            timeout=timeout, priority=priority, progress=progress, cache_key=cache_key)
+
+  def send_photo(self, chat_id, photo,
+                 filename='photo',
+                 caption=None,
+                 reply_to_message_id=None,
+                 reply_markup=None,
+                 timeout=None,
+                 priority=PRIORITY_NORMAL,
+                 progress=None,
+                 cache_key=None):
+    return self._send_media('sendPhoto', 'photo', chat_id, photo, filename,
+                            caption=caption, reply_to_message_id=reply_to_message_id, reply_markup=reply_markup,
+                            timeout=timeout, priority=priority, progress=progress, cache_key=cache_key)
 
+  @inlineCallbacks
+  def _send_media(self, method, field, chat_id, media, filename,
+                  params=None,
+                  caption=None,
+                  reply_to_message_id=None,
+                  reply_markup=None,
+                  timeout=None,
+                  priority=PRIORITY_NORMAL,
+                  progress=None,
+                  cache_key=None):
     payload = {'chat_id': chat_id}
-    files = None
-    if not is_string(audio):
-      files = {'audio': (filename, audio)}
-    else:
-      payload['audio'] = audio
-    if duration:
-      payload['duration'] = duration
-    if performer:
-      payload['performer'] = performer
-    if title:
-      payload['title'] = title
+    if params:
+      payload.update((key, value) for key, value in params.items() if value)
     if caption:
       payload['caption'] = caption
     if reply_to_message_id:
@@ -451,10 +1017,75 @@ class TelegramBot(object):
     if reply_markup:
       payload['reply_markup'] = _convert_markup(reply_markup)
 
-    request = yield self._request(method, 'POST', params=payload, files=files, timeout=timeout)
-    returnValue(Message.de_json(request))
+    key = None
+    cached_key = None
+    original_media = media
+    if self.media_cache is not None and not is_string(media):
+      key = yield self.media_cache.key(self.id, field, media, cache_key)
+      while key is not None:
+        file_id = self.media_cache.get(key)
+        if file_id is None:
+          uploading = self.media_cache.begin_upload(key)
+          if uploading is None:
+            break
+          file_id = yield uploading
+        if file_id is not None:
+          media = file_id
+          cached_key, key = key, None
+
+    files = None
+    upload = None
+    file_id = None
+    try:
+      if is_string(media):
+        # file_id or URL
+        payload[field] = media
+      else:
+        upload = media if isinstance(media, InputFile) else InputFile(media, filename)
+        files = {field: upload.open(progress)}
+
+      try:
+        request = yield self._request(method, 'POST', params=payload, files=files, timeout=timeout,
+                                      priority=priority)
+      except ApiException as e:
+        if cached_key is None or e.error_code != 400 or e.migrate_to_chat_id is not None \
+            or not INVALID_FILE_ID_PATTERN.search(e.description or ''):
+          raise
+        # Telegram no longer accepts the cached file_id, forget it and upload the file again
+        self.media_cache.evict(cached_key)
+        message = yield self._send_media(method, field, chat_id, original_media, filename, params=params,
+                                         caption=caption, reply_to_message_id=reply_to_message_id,
+                                         reply_markup=reply_markup, timeout=timeout, priority=priority,
+                                         progress=progress, cache_key=cache_key)
+        returnValue(message)
+      message = Message.de_json(request)
+      if key is not None:
+        sent = getattr(message, field, None)
+        if isinstance(sent, list):
+          # photo sizes, the largest one comes last
+          sent = sent[-1] if sent else None
+        file_id = sent.file_id if sent is not None else None
+    finally:
+      if upload is not None:
+        upload.close()
+      if key is not None:
+        self.media_cache.finish_upload(key, file_id)
+    returnValue(message)
+
+  def broadcast(self, chat_ids, text=None, send=None,
+                checkpoint_path=None,
+                concurrency=10,
+                progress=None,
+                **kwargs):
+    if send is None:
+      def send(chat_id):
+        return self.send_message(chat_id, text, priority=PRIORITY_BULK, **kwargs)
+
+    return Broadcast(self, chat_ids, send,
+                     checkpoint_path=checkpoint_path, concurrency=concurrency, progress=progress).run()
 
   def reply_to(self, message, text, **kwargs):
+    kwargs.setdefault('priority', PRIORITY_HIGH)
     return self.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
 
   def send_chat_action(self, chat_id, action):
@@ -463,37 +1094,146 @@ class TelegramBot(object):
     payload = {'chat_id': chat_id, 'action': action}
     return self._make_request(method, 'POST', params=payload)
 
-  def register_for_reply(self, message, callback):
-    self.message_subscribers[message.message_id] = callback
+  def register_for_reply(self, message, callback, ttl=None):
+    self.message_subscribers.set(message.message_id, callback, ttl)
+
+  def register_next_chat_handler(self, chat_id, callback, ttl=None):
+    self.message_next_handlers.set(chat_id, callback, ttl)
 
-  def register_next_chat_handler(self, chat_id, callback):
-    self.message_next_handlers[chat_id] = callback
+  @staticmethod
+  def _on_conversation_evicted(key, callback, reason):
+    log.warn("Dropped handler {callback} for {key} ({reason})", callback=callback, key=key, reason=reason)
 
   @inlineCallbacks
-  def _request(self, method_name, method='get', params=None, data=None, files=None, timeout=None, **kwargs):
+  def _request(self, method_name, method='get', params=None, data=None, files=None, timeout=None,
+               priority=PRIORITY_NORMAL, **kwargs):
     if self.on_api_request_listener:
       self.on_api_request_listener(method_name)
     result_json = yield self._make_request(method_name, method,
                                            params=params, data=data, files=files, timeout=timeout,
-                                           **kwargs)
+                                           priority=priority, **kwargs)
     returnValue(result_json['result'])
 
   @inlineCallbacks
-  def _make_request(self, method_name, method='get', params=None, data=None, files=None, timeout=None, **kwargs):
+  def _make_request(self, method_name, method='get', params=None, data=None, files=None, timeout=None,
+                    priority=PRIORITY_NORMAL, **kwargs):
     request_url = API_URL + 'bot' + self.token + '/' + method_name
     params = _convert_utf8(params)
 
     if timeout is None:
       timeout = self.timeout
 
-    resp = yield treq.request(method, request_url, params=params, data=data, files=files, timeout=timeout,
-                              agent=self.agent, **kwargs)
-    result_json = yield _check_response(resp, method_name)
-    returnValue(result_json)
+    chat_id = params.get('chat_id') if params else None
+    if chat_id is not None and str(chat_id) in self.chat_migrations:
+      params['chat_id'] = chat_id = self.chat_migrations[str(chat_id)]
+
+    attempt = 0
+    while True:
+      try:
+        if self.rate_limiter is not None and method_name in RATE_LIMITED_METHODS:
+          yield self.rate_limiter.acquire(chat_id, priority)
+
+        result_json = yield self._send_request(method_name, method, request_url, params, data, files, timeout,
+                                               **kwargs)
+        returnValue(result_json)
+      except ApiException as e:
+        if e.migrate_to_chat_id is not None and chat_id is not None and str(chat_id) not in self.chat_migrations:
+          log.info("Chat {chat_id} migrated to {new_chat_id}", chat_id=chat_id, new_chat_id=e.migrate_to_chat_id)
+          self.chat_migrations[str(chat_id)] = str(e.migrate_to_chat_id)
+          if not files:
+            params['chat_id'] = chat_id = str(e.migrate_to_chat_id)
+            continue
+        failure = Failure()
+        delay = self._retry_delay(method_name, attempt, e)
+      except RETRY_ALWAYS_ERRORS as e:
+        failure = Failure()
+        delay = self._retry_delay(method_name, attempt, e)
+      except RETRY_IDEMPOTENT_ERRORS as e:
+        failure = Failure()
+        delay = self._retry_delay(method_name, attempt, e) if method_name in IDEMPOTENT_METHODS else None
+
+      if delay is None or files:
+        # an upload body can only be produced once
+        failure.raiseException()
+      attempt += 1
+      log.debug("Retrying {method_name} in {delay:.2f} seconds (attempt {attempt})",
+                method_name=method_name, delay=delay, attempt=attempt)
+      yield deferLater(self.clock, delay, lambda: None)
+
+  def _send_request(self, method_name, method, request_url, params, data, files, timeout, **kwargs):
+    if self.circuit_breaker is not None:
+      # fails fast with CircuitOpenError while the API is down
+      self.circuit_breaker.allow()
+    d = treq.request(method, request_url, params=params, data=data, files=files,
+                     agent=self.poll_agent if method_name == 'getUpdates' else self.agent, **kwargs)
+    d.addCallback(_check_response, method_name)
+    timed_out = []
+    if timeout is not None:
+      # the request's own deadline, told apart from a cancel by the caller
+      timer = self.clock.callLater(timeout, lambda: (timed_out.append(True), d.cancel()))
+      d.addBoth(lambda result: (timer.cancel() if timer.active() else None, result)[1])
+    d.addErrback(self._translate_cancellation, method_name, timeout, timed_out)
+    if self.circuit_breaker is not None:
+      d.addBoth(self._record_api_health)
+    if self.metrics is not None:
+      d.addBoth(self._observe_request, method_name, self.clock.seconds())
+    return d
+
+  @staticmethod
+  def _translate_cancellation(failure, method_name, timeout, timed_out):
+    if not _is_cancellation(failure):
+      return failure
+    if timed_out:
+      raise RequestTimeoutError(method_name, timeout)
+    raise CancelledError()
+
+  def _record_api_health(self, result):
+    if isinstance(result, Failure) and result.check(CancelledError):
+      # the caller gave up, that says nothing about the API
+      self.circuit_breaker.record_cancelled()
+      return result
+    if isinstance(result, Failure) and not (result.check(ApiException) and result.value.error_code < 500):
+      self.circuit_breaker.record_failure()
+    else:
+      # an error answer from Telegram still means the API is up
+      self.circuit_breaker.record_success()
+    return result
+
+  def _observe_request(self, result, method_name, started):
+    self.metrics.api_request_duration.observe(self.clock.seconds() - started, (self.name, method_name))
+    if not isinstance(result, Failure):
+      status = '200'
+    elif isinstance(result.value, ApiException):
+      status = str(result.value.error_code or 'error')
+    else:
+      status = result.type.__name__
+    self.metrics.api_responses.inc((self.name, method_name, status))
+    return result
+
+  def _retry_delay(self, method_name, attempt, error):
+    if attempt >= self.max_retries:
+      return None
+    if isinstance(error, ApiException):
+      if error.retry_after is not None:
+        return error.retry_after
+      if error.error_code < 500 or method_name not in IDEMPOTENT_METHODS:
+        return None
+    return random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** attempt))
 
 
 class ApiException(Exception):
-  def __init__(self, msg, method_name, result):
+  def __init__(self, msg, method_name, result, error_code=None, description=None, parameters=None):
     super(ApiException, self).__init__("A request to the Telegram API was unsuccessful. {0}".format(msg))
     self.function_name = method_name
     self.result = result
+    self.error_code = error_code
+    self.description = description
+    self.parameters = parameters or {}
+
+  @property
+  def retry_after(self):
+    return self.parameters.get('retry_after')
+
+  @property
+  def migrate_to_chat_id(self):
+    return self.parameters.get('migrate_to_chat_id')
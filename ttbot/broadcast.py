@@ -0,0 +1,171 @@
+import json
+import os
+from itertools import islice
+
+from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList, FirstError
+from twisted.internet.task import Cooperator, LoopingCall, TaskFinished, deferLater
+from twisted.logger import Logger
+from twisted.python.failure import Failure
+
+from ttbot.ratelimit import RateLimiter
+
+log = Logger()
+
+
+class BroadcastStats(object):
+  def __init__(self, started, position=0):
+    self.started = started
+    self.finished = None
+    self.position = position
+    self.sent = 0
+    self.blocked = 0
+    self.failed = 0
+    self.resumed_sent = 0
+    # outcomes of the chats before position only, chats finished past it are sent again on resume
+    self.checkpointed = {'sent': 0, 'blocked': 0, 'failed': 0}
+
+  def elapsed(self, now):
+    return (self.finished if self.finished is not None else now) - self.started
+
+  def rate(self, now):
+    elapsed = self.elapsed(now)
+    return (self.sent - self.resumed_sent) / float(elapsed) if elapsed > 0 else 0.0
+
+  def to_dict(self):
+    checkpoint = {'position': self.position}
+    checkpoint.update(self.checkpointed)
+    return checkpoint
+
+
+class Broadcast(object):
+  def __init__(self, bot, chat_ids, send, checkpoint_path=None, concurrency=10, checkpoint_every=100,
+               progress=None, progress_interval=10, rate_limiter=None):
+    self.bot = bot
+    self.chat_ids = chat_ids
+    self.send = send
+    self.checkpoint_path = checkpoint_path
+    self.concurrency = concurrency
+    self.checkpoint_every = checkpoint_every
+    self.progress = progress
+    self.progress_interval = progress_interval
+    self.clock = bot.clock
+    if rate_limiter is None and bot.rate_limiter is None:
+      # the bot does not pace its requests, so the broadcast has to
+      rate_limiter = RateLimiter(clock=self.clock, global_rate=25, global_burst=1)
+    self.rate_limiter = rate_limiter
+    self.stats = None
+    self._done = {}
+    self._sending = set()
+    self._unsaved = 0
+
+  def load_checkpoint(self):
+    if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+      return {}
+    with open(self.checkpoint_path) as f:
+      return json.load(f)
+
+  def save_checkpoint(self):
+    self._unsaved = 0
+    if self.checkpoint_path is None:
+      return
+    partial_path = self.checkpoint_path + '.tmp'
+    with open(partial_path, 'w') as f:
+      json.dump(self.stats.to_dict(), f)
+    os.rename(partial_path, self.checkpoint_path)
+
+  def run(self):
+    checkpoint = self.load_checkpoint()
+    self.stats = BroadcastStats(self.clock.seconds(), checkpoint.get('position', 0))
+    for outcome in self.stats.checkpointed:
+      self.stats.checkpointed[outcome] = checkpoint.get(outcome, 0)
+    self.stats.sent = self.stats.resumed_sent = self.stats.checkpointed['sent']
+    self.stats.blocked = self.stats.checkpointed['blocked']
+    self.stats.failed = self.stats.checkpointed['failed']
+    if self.stats.position:
+      log.info("Resuming broadcast after {position} chats", position=self.stats.position)
+
+    chat_ids = enumerate(islice(self.chat_ids, self.stats.position, None), self.stats.position)
+    work = (self._start(index, chat_id) for index, chat_id in chat_ids)
+    cooperator = Cooperator(scheduler=lambda f: self.clock.callLater(0, f))
+
+    reporter = LoopingCall(self._report)
+    reporter.clock = self.clock
+    reporter.start(self.progress_interval, now=False)
+
+    tasks = [cooperator.cooperate(work) for _ in range(self.concurrency)]
+
+    def _finished(result):
+      reporter.stop()
+      self.stats.finished = self.clock.seconds()
+      self.save_checkpoint()
+      self._report()
+      return result if isinstance(result, Failure) else self.stats
+
+    def _failed(failure):
+      # the chat ids or a checkpoint failed, the other tasks would only fail the same way
+      for task in tasks:
+        try:
+          task.stop()
+        except TaskFinished:
+          pass
+      if failure.check(FirstError):
+        failure = failure.value.subFailure
+      # sends already under way still count towards the checkpoint
+      sending = DeferredList(list(self._sending), consumeErrors=True)
+      return sending.addCallback(lambda _: failure)
+
+    d = DeferredList([task.whenDone() for task in tasks], fireOnOneErrback=True, consumeErrors=True)
+    return d.addErrback(_failed).addBoth(_finished)
+
+  def _start(self, index, chat_id):
+    d = self._send_one(index, chat_id)
+    if not d.called:
+      self._sending.add(d)
+      d.addBoth(self._sent, d)
+    return d
+
+  def _sent(self, result, d):
+    self._sending.discard(d)
+    return result
+
+  @inlineCallbacks
+  def _send_one(self, index, chat_id):
+    while True:
+      if self.rate_limiter is not None:
+        yield self.rate_limiter.acquire()
+      try:
+        yield self.send(chat_id)
+        self.stats.sent += 1
+        outcome = 'sent'
+      except Exception as e:
+        if getattr(e, 'retry_after', None):
+          yield deferLater(self.clock, e.retry_after, lambda: None)
+          continue
+        if getattr(e, 'error_code', None) == 403:
+          # the bot was blocked or kicked, nothing to retry
+          self.stats.blocked += 1
+          outcome = 'blocked'
+        else:
+          log.failure("Broadcast to {chat_id} failed", chat_id=chat_id)
+          self.stats.failed += 1
+          outcome = 'failed'
+      break
+    self._complete(index, outcome)
+    returnValue(None)
+
+  def _complete(self, index, outcome):
+    self._done[index] = outcome
+    while self.stats.position in self._done:
+      self.stats.checkpointed[self._done.pop(self.stats.position)] += 1
+      self.stats.position += 1
+    self._unsaved += 1
+    if self._unsaved >= self.checkpoint_every:
+      self.save_checkpoint()
+
+  def _report(self):
+    now = self.clock.seconds()
+    log.info("Broadcast: {sent} sent, {blocked} blocked, {failed} failed, {rate:.1f} msg/s",
+             sent=self.stats.sent, blocked=self.stats.blocked, failed=self.stats.failed,
+             rate=self.stats.rate(now))
+    if self.progress is not None:
+      self.progress(self.stats)
@@ -0,0 +1,64 @@
+import json
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  import ujson
+except ImportError:
+  ujson = None
+
+
+def _json_loads(data):
+  return json.loads(data)
+
+
+def _json_dumps(obj, ensure_ascii=False):
+  return json.dumps(obj, ensure_ascii=ensure_ascii)
+
+
+def _orjson_loads(data):
+  return orjson.loads(data)
+
+
+def _orjson_dumps(obj, ensure_ascii=False):
+  if ensure_ascii:
+    return json.dumps(obj, ensure_ascii=True)
+  return orjson.dumps(obj).decode('utf-8')
+
+
+def _ujson_loads(data):
+  return ujson.loads(data)
+
+
+def _ujson_dumps(obj, ensure_ascii=False):
+  result = ujson.dumps(obj, ensure_ascii=ensure_ascii, escape_forward_slashes=False)
+  if isinstance(result, bytes):
+    result = result.decode('utf-8')
+  return result
+
+
+BACKENDS = {
+  'json': (_json_loads, _json_dumps),
+  'orjson': (_orjson_loads, _orjson_dumps),
+  'ujson': (_ujson_loads, _ujson_dumps),
+}
+
+# refer to codec.loads/codec.dumps through the module, so that use() takes effect everywhere;
+# loads() accepts raw response bytes
+backend = None
+loads = None
+dumps = None
+
+
+def use(name):
+  global backend, loads, dumps
+  if name == 'orjson' and orjson is None or name == 'ujson' and ujson is None:
+    raise ImportError("JSON backend {0} is not installed".format(name))
+  backend = name
+  loads, dumps = BACKENDS[name]
+
+
+use('orjson' if orjson is not None else 'ujson' if ujson is not None else 'json')
@@ -0,0 +1,84 @@
+import re
+
+LITERAL_COMMAND = re.compile(r'^\w+$')
+
+
+class _IndexedHandler(object):
+  __slots__ = ('position', 'function', 'has_commands', 'command_patterns', 'regexp', 'func')
+
+  def __init__(self, position, message_handler):
+    self.position = position
+    self.function = message_handler['function']
+    self.has_commands = 'commands' in message_handler
+    self.command_patterns = []
+    self.regexp = None
+    self.func = message_handler.get('lambda')
+
+    if message_handler.get('regexp'):
+      self.regexp = re.compile(message_handler['regexp'])
+
+
+class MessageHandlerIndex(object):
+  def __init__(self):
+    self.size = 0
+    self._commands = {}
+    self._text_command_handlers = []
+    self._text_handlers = []
+    self._other_handlers = {}
+
+  def add(self, message_handler):
+    handler = _IndexedHandler(self.size, message_handler)
+    self.size += 1
+
+    for content_type in message_handler['content_types']:
+      if content_type != 'text':
+        if handler.func is not None:
+          self._other_handlers.setdefault(content_type, []).append(handler)
+        continue
+
+      if handler.has_commands:
+        for command_pattern in message_handler['commands'] or []:
+          if LITERAL_COMMAND.match(command_pattern):
+            self._commands.setdefault(command_pattern, handler)
+          else:
+            if not command_pattern.endswith('$'):
+              command_pattern += '$'
+            handler.command_patterns.append(re.compile(command_pattern))
+        if handler.command_patterns:
+          self._text_command_handlers.append(handler)
+      elif handler.regexp is not None or handler.func is not None:
+        self._text_command_handlers.append(handler)
+
+      if handler.regexp is not None or handler.func is not None:
+        self._text_handlers.append(handler)
+
+  def find(self, message, command):
+    if message.content_type != 'text':
+      for handler in self._other_handlers.get(message.content_type, ()):
+        if handler.func(message):
+          return handler.function
+      return None
+
+    if not command:
+      for handler in self._text_handlers:
+        if handler.regexp is not None and handler.regexp.search(message.text):
+          return handler.function
+        if handler.func is not None and handler.func(message):
+          return handler.function
+      return None
+
+    # handlers with commands decide on command messages alone, the literal ones are a dict lookup
+    found = self._commands.get(command)
+    for handler in self._text_command_handlers:
+      if found is not None and handler.position >= found.position:
+        break
+      if handler.has_commands:
+        for command_pattern in handler.command_patterns:
+          if command_pattern.match(command):
+            return handler.function
+        continue
+      if handler.regexp is not None and handler.regexp.search(message.text):
+        return handler.function
+      if handler.func is not None and handler.func(message):
+        return handler.function
+    return found.function if found is not None else None
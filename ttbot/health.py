@@ -0,0 +1,86 @@
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+
+from ttbot import codec
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+  def __init__(self, retry_after):
+    super(CircuitOpenError, self).__init__("Telegram API looks unavailable, retry in {0:.1f} seconds"
+                                           .format(retry_after))
+    self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+  def __init__(self, failure_threshold=5, reset_timeout=30, probe_timeout=90, clock=None):
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    # longer than a long poll, a probe may be a getUpdates call
+    self.probe_timeout = probe_timeout
+    self.clock = clock or reactor
+    self.state = CLOSED
+    self.failures = 0
+    self.opened_at = None
+    self._probing = False
+    self._probe_timer = None
+
+  def allow(self):
+    if self.state == CLOSED:
+      return
+    remaining = self.opened_at + self.reset_timeout - self.clock.seconds()
+    if self.state == OPEN and remaining <= 0:
+      self.state = HALF_OPEN
+    if self.state == HALF_OPEN and not self._probing:
+      # a single request finds out whether the API is back
+      self._probing = True
+      self._probe_timer = self.clock.callLater(self.probe_timeout, self._probe_expired)
+      return
+    raise CircuitOpenError(max(remaining, 1))
+
+  def record_success(self):
+    self.state = CLOSED
+    self.failures = 0
+    self._end_probe()
+
+  def record_failure(self):
+    self.failures += 1
+    if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+      self.state = OPEN
+      self.opened_at = self.clock.seconds()
+    self._end_probe()
+
+  def record_cancelled(self):
+    # a cancelled request tells nothing, let the next one probe
+    self._end_probe()
+
+  def _end_probe(self):
+    self._probing = False
+    if self._probe_timer is not None:
+      if self._probe_timer.active():
+        self._probe_timer.cancel()
+      self._probe_timer = None
+
+  def _probe_expired(self):
+    # the probe hangs, so the API is not back
+    self._probe_timer = None
+    if self._probing:
+      self.record_failure()
+
+
+class HealthResource(Resource):
+  # serves target.health() for probes, a TelegramBot or a BotHost
+  isLeaf = True
+
+  def __init__(self, target):
+    Resource.__init__(self)
+    self.target = target
+
+  def render_GET(self, request):
+    health = self.target.health()
+    request.setResponseCode(200 if health['healthy'] else 503)
+    request.setHeader(b'Content-Type', b'application/json')
+    return codec.dumps(health).encode('utf-8')
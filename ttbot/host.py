@@ -0,0 +1,87 @@
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, DeferredSemaphore, maybeDeferred
+from twisted.logger import Logger
+from twisted.web.client import HTTPConnectionPool
+
+from ttbot import TelegramBot, codec
+from ttbot.metrics import Metrics
+
+log = Logger()
+
+
+class PollScheduler(object):
+  def __init__(self, max_concurrent_polls=20, contended_poll_timeout=5):
+    self.max_concurrent_polls = max_concurrent_polls
+    self.contended_poll_timeout = contended_poll_timeout
+    self._semaphore = DeferredSemaphore(max_concurrent_polls)
+
+  @property
+  def waiting(self):
+    return len(self._semaphore.waiting)
+
+  def poll(self, get_updates, telegram_timeout):
+    # waiting bots are served in arrival order. A bot that gets a slot while others queue behind it
+    # still long polls, only shorter, so slots keep rotating while idle polling stays bounded by
+    # max_concurrent_polls / contended_poll_timeout requests a second
+    def _run(semaphore):
+      timeout = min(telegram_timeout, self.contended_poll_timeout) if semaphore.waiting else telegram_timeout
+      d = maybeDeferred(get_updates, timeout)
+      return d.addBoth(lambda result: (semaphore.release(), result)[1])
+
+    return self._semaphore.acquire().addCallback(_run)
+
+
+class BotHost(object):
+  def __init__(self, pool_size=10, pool_idle_timeout=240, max_concurrent_polls=20, contended_poll_timeout=5,
+               metrics=None, json_backend=None):
+    if json_backend is not None:
+      codec.use(json_backend)
+    self.pool = HTTPConnectionPool(reactor, persistent=True)
+    self.pool.maxPersistentPerHost = pool_size
+    self.pool.cachedConnectionTimeout = pool_idle_timeout
+    self.poll_pool = HTTPConnectionPool(reactor, persistent=True)
+    self.poll_pool.maxPersistentPerHost = max_concurrent_polls
+    self.poll_pool.cachedConnectionTimeout = pool_idle_timeout
+    self.poll_scheduler = PollScheduler(max_concurrent_polls, contended_poll_timeout)
+    self.metrics = metrics if metrics is not None else Metrics()
+    self.bots = {}
+    self.running = False
+    self._update_kwargs = {}
+
+  def add_bot(self, token, name, **kwargs):
+    if name in self.bots:
+      raise ValueError("Bot {0} is already hosted".format(name))
+    kwargs.setdefault('metrics', self.metrics)
+    bot = TelegramBot(token, name, pool=self.pool, poll_pool=self.poll_pool, poll_scheduler=self.poll_scheduler,
+                      **kwargs)
+    self.bots[name] = bot
+    if self.running:
+      bot.start_update(**self._update_kwargs)
+    return bot
+
+  def remove_bot(self, name):
+    bot = self.bots.pop(name)
+    bot.stop_update()
+    # syncs the journal and closes the state stores, the shared pools stay open
+    bot.close()
+    return bot
+
+  def start(self, **kwargs):
+    self.running = True
+    self._update_kwargs = kwargs
+    for bot in self.bots.itervalues():
+      bot.start_update(**kwargs)
+    log.info("Started {count} bots", count=len(self.bots))
+
+  def health(self):
+    bots = dict((name, bot.health()) for name, bot in self.bots.iteritems())
+    return {'healthy': all(health['healthy'] for health in bots.itervalues()), 'bots': bots}
+
+  def stop(self):
+    self.running = False
+    closing = []
+    for bot in self.bots.itervalues():
+      bot.stop_update()
+      closing.append(bot.close())
+    closing.extend([self.pool.closeCachedConnections(), self.poll_pool.closeCachedConnections()])
+    return DeferredList(closing)
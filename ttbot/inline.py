@@ -0,0 +1,123 @@
+from cachetools import TTLCache
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, maybeDeferred, returnValue, succeed
+from twisted.internet.task import deferLater
+from twisted.python.failure import Failure
+
+from ttbot import serialize_inline_results
+
+
+class InlineAnswer(object):
+  def __init__(self, results, next_offset='', personal=False, switch_pm_text=None, switch_pm_parameter=None):
+    self.results = results
+    self.next_offset = next_offset
+    self.personal = personal
+    self.switch_pm_text = switch_pm_text
+    self.switch_pm_parameter = switch_pm_parameter
+
+
+class InlineQueryLayer(object):
+  # use as bot.inline_query_handler; handler(inline_query, bot) returns a list of results or an InlineAnswer
+  def __init__(self, handler, cache_size=10000, cache_ttl=300, personal=False, debounce=0.3, clock=None):
+    self.handler = handler
+    self.personal = personal
+    self.debounce = debounce
+    self.clock = clock or reactor
+    self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl, timer=self.clock.seconds)
+    self.hits = 0
+    self.misses = 0
+    self.coalesced = 0
+    self.dropped = 0
+    self._in_flight = {}
+    self._latest = {}
+
+  @inlineCallbacks
+  def __call__(self, inline_query, bot):
+    user_id = inline_query.from_user.id
+    self._latest[user_id] = inline_query.query_id
+    try:
+      answer = self._cached(inline_query)
+      if answer is not None:
+        # nothing to compute, so nothing to debounce
+        self.hits += 1
+      else:
+        if self.debounce:
+          yield deferLater(self.clock, self.debounce, lambda: None)
+          if self._superseded(inline_query):
+            return
+        answer = yield self._answer(inline_query, bot)
+        if answer is None:
+          # the query this one was coalesced with got a personal answer, which is not ours to show
+          answer = yield self._compute(inline_query, bot)
+        if self._superseded(inline_query):
+          return
+      result = yield bot.answer_to_inline_query(inline_query.query_id, answer.results, answer.personal,
+                                                answer.next_offset, answer.switch_pm_text,
+                                                answer.switch_pm_parameter)
+      returnValue(result)
+    finally:
+      if self._latest.get(user_id) == inline_query.query_id:
+        del self._latest[user_id]
+
+  def _superseded(self, inline_query):
+    # the user kept typing, nobody will see an answer to this query
+    if self._latest.get(inline_query.from_user.id) != inline_query.query_id:
+      self.dropped += 1
+      return True
+    return False
+
+  def _keys(self, inline_query):
+    # (shared key, this user's key), personal answers are only ever cached under the user's key
+    user_key = (inline_query.query, inline_query.offset, inline_query.from_user.id)
+    return user_key if self.personal else (inline_query.query, inline_query.offset, None), user_key
+
+  def _cached(self, inline_query):
+    shared_key, user_key = self._keys(inline_query)
+    answer = self.cache.get(shared_key)
+    if answer is None and user_key != shared_key:
+      answer = self.cache.get(user_key)
+    return answer
+
+  def _answer(self, inline_query, bot):
+    answer = self._cached(inline_query)
+    if answer is not None:
+      self.hits += 1
+      return succeed(answer)
+
+    shared_key, _ = self._keys(inline_query)
+    waiters = self._in_flight.get(shared_key)
+    if waiters is not None:
+      self.coalesced += 1
+      d = Deferred()
+      waiters.append(d)
+      return d
+
+    self.misses += 1
+    self._in_flight[shared_key] = []
+    return self._compute(inline_query, bot).addBoth(self._resolve, shared_key)
+
+  def _compute(self, inline_query, bot):
+    d = maybeDeferred(self.handler, inline_query, bot)
+    return d.addCallback(self._serialize).addCallback(self._store, inline_query)
+
+  def _serialize(self, answer):
+    if not isinstance(answer, InlineAnswer):
+      answer = InlineAnswer(answer, personal=self.personal)
+    if not isinstance(answer.results, basestring):
+      answer.results = serialize_inline_results(answer.results)
+    return answer
+
+  def _store(self, answer, inline_query):
+    shared_key, user_key = self._keys(inline_query)
+    self.cache[user_key if answer.personal else shared_key] = answer
+    return answer
+
+  def _resolve(self, result, key):
+    for d in self._in_flight.pop(key):
+      if isinstance(result, Failure):
+        d.errback(result)
+      elif result.personal and key[2] is None:
+        d.callback(None)
+      else:
+        d.callback(result)
+    return result
@@ -0,0 +1,133 @@
+import os
+from collections import deque
+
+from twisted.logger import Logger
+
+from ttbot import codec
+
+log = Logger()
+
+
+class UpdateJournal(object):
+  # one JSON object per line: {"u": update} when an update arrives, {"d": update_id} once it has been
+  # handled and {"c": update_id} when the offset moves past it
+  def __init__(self, path, compact_every=10000, max_completed=10000):
+    self.path = path
+    self.compact_every = compact_every
+    self.max_completed = max_completed
+    self.offset = None
+    self._pending = {}
+    self._journaled = set()
+    # finished update ids in completion order, they deduplicate redeliveries until the offset passes them
+    self._completed = deque()
+    self._records = 0
+    self._dirty = False
+    self._load()
+    self._file = open(self.path, 'ab')
+
+  def _load(self):
+    if not os.path.exists(self.path):
+      return
+    with open(self.path, 'r+b') as f:
+      data = f.read()
+      if data and not data.endswith(b'\n'):
+        # a write interrupted by a crash, cut it off so the next record starts on a line of its own
+        log.warn("Truncating the unfinished last record of {path}", path=self.path)
+        data = data[:data.rfind(b'\n') + 1]
+        f.truncate(len(data))
+    for line in data.splitlines():
+      try:
+        record = codec.loads(line)
+      except ValueError:
+        log.warn("Skipping unreadable journal record in {path}", path=self.path)
+        continue
+      self._records += 1
+      if 'u' in record:
+        update = record['u']
+        self._journaled.add(update['update_id'])
+        self._pending[update['update_id']] = update
+      elif 'd' in record:
+        self._journaled.add(record['d'])
+        self._completed.append(record['d'])
+        self._pending.pop(record['d'], None)
+      elif 'c' in record:
+        self._forget(record['c'])
+
+  def _forget(self, offset):
+    self.offset = offset if self.offset is None else max(self.offset, offset)
+    self._journaled = set(update_id for update_id in self._journaled if update_id > self.offset)
+    self._completed = deque(update_id for update_id in self._completed if update_id > self.offset)
+    for update_id in [update_id for update_id in self._pending if update_id <= self.offset]:
+      del self._pending[update_id]
+
+  def _write(self, record):
+    self._file.write(codec.dumps(record).encode('utf-8') + b'\n')
+    self._records += 1
+    self._dirty = True
+
+  def pending_updates(self):
+    return [self._pending[update_id] for update_id in sorted(self._pending)]
+
+  @property
+  def last_journaled_id(self):
+    return max(self._journaled) if self._journaled else self.offset
+
+  def record(self, updates):
+    new_updates = []
+    for update in updates:
+      update_id = update['update_id']
+      if update_id in self._journaled or self.offset is not None and update_id <= self.offset:
+        continue
+      self._journaled.add(update_id)
+      self._pending[update_id] = update
+      self._write({'u': update})
+      new_updates.append(update)
+    return new_updates
+
+  def complete(self, update_ids):
+    for update_id in update_ids:
+      if self._pending.pop(update_id, None) is not None:
+        self._completed.append(update_id)
+        self._write({'d': update_id})
+
+  def commit(self, offset):
+    if self.offset is not None and offset <= self.offset:
+      return
+    self._write({'c': offset})
+    self._forget(offset)
+    if self._records >= self.compact_every:
+      self.compact()
+
+  def forget_completed(self):
+    # webhook updates arrive out of order and there is no offset to commit, so only the max_completed most
+    # recently finished ids are kept to recognise redeliveries
+    while len(self._completed) > self.max_completed:
+      self._journaled.discard(self._completed.popleft())
+    if self._records >= self.compact_every:
+      self.compact()
+
+  def sync(self):
+    if self._dirty:
+      self._file.flush()
+      os.fsync(self._file.fileno())
+      self._dirty = False
+
+  def compact(self):
+    partial_path = self.path + '.tmp'
+    with open(partial_path, 'wb') as f:
+      records = [{'c': self.offset}] if self.offset is not None else []
+      records.extend({'u': update} for update in self.pending_updates())
+      records.extend({'d': update_id} for update_id in self._completed if update_id in self._journaled)
+      for record in records:
+        f.write(codec.dumps(record).encode('utf-8') + b'\n')
+      f.flush()
+      os.fsync(f.fileno())
+    self._file.close()
+    os.rename(partial_path, self.path)
+    self._file = open(self.path, 'ab')
+    self._records = len(records)
+    self._dirty = False
+
+  def close(self):
+    self.sync()
+    self._file.close()
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import shelve
+
+from cachetools import LRUCache
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThread
+from twisted.web.iweb import IBodyProducer
+
+from ttbot.streaming import InputFile
+
+HASH_CHUNK_SIZE = 64 * 1024
+# larger sources are hashed in a thread so the reactor isn't blocked reading them
+INLINE_HASH_SIZE = 64 * 1024
+
+
+def _source_size(source):
+  if isinstance(source, basestring):
+    return os.path.getsize(source)
+  position = source.tell()
+  source.seek(0, os.SEEK_END)
+  size = source.tell() - position
+  source.seek(position)
+  return size
+
+
+def content_digest(media):
+  source = media.source if isinstance(media, InputFile) else media
+  if IBodyProducer.providedBy(source):
+    return None
+
+  digest = hashlib.sha1()
+  if isinstance(source, basestring):
+    with open(source, 'rb') as f:
+      for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+  else:
+    position = source.tell()
+    for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+      digest.update(chunk)
+    source.seek(position)
+  return digest.hexdigest()
+
+
+class MediaCache(object):
+  def __init__(self, maxsize=10000, path=None):
+    self._memory = LRUCache(maxsize=maxsize)
+    self._disk = shelve.open(path) if path else None
+    self._uploads = {}
+
+  def key(self, bot_id, media_type, media, cache_key=None):
+    # file_ids only work for the bot that uploaded the file
+    if cache_key is not None:
+      return succeed('{0}:{1}:{2}'.format(bot_id, media_type, cache_key))
+    source = media.source if isinstance(media, InputFile) else media
+    if IBodyProducer.providedBy(source):
+      return succeed(None)
+    if _source_size(source) <= INLINE_HASH_SIZE:
+      d = succeed(content_digest(media))
+    else:
+      d = deferToThread(content_digest, media)
+    return d.addCallback(lambda digest: '{0}:{1}:{2}'.format(bot_id, media_type, digest))
+
+  def get(self, key):
+    file_id = self._memory.get(key)
+    if file_id is None and self._disk is not None:
+      file_id = self._disk.get(key)
+      if file_id is not None:
+        self._memory[key] = file_id
+    return file_id
+
+  def set(self, key, file_id):
+    self._memory[key] = file_id
+    if self._disk is not None:
+      self._disk[key] = file_id
+
+  def evict(self, key):
+    self._memory.pop(key, None)
+    if self._disk is not None and key in self._disk:
+      del self._disk[key]
+
+  def begin_upload(self, key):
+    # None means the caller uploads, otherwise wait for the upload already in flight
+    waiters = self._uploads.get(key)
+    if waiters is None:
+      self._uploads[key] = []
+      return None
+    d = Deferred()
+    waiters.append(d)
+    return d
+
+  def finish_upload(self, key, file_id):
+    if file_id is not None:
+      self.set(key, file_id)
+    for d in self._uploads.pop(key, []):
+      d.callback(file_id)
+
+  def close(self):
+    if self._disk is not None:
+      self._disk.close()
+      self._disk = None
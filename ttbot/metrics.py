@@ -0,0 +1,133 @@
+from bisect import bisect_left
+
+from twisted.web.resource import Resource
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BATCH_SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+  pairs = ['{0}="{1}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+  if extra is not None:
+    pairs.append('{0}="{1}"'.format(*extra))
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+  if isinstance(value, float):
+    return repr(value)
+  return str(value)
+
+
+class Counter(object):
+  type = 'counter'
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.values = {}
+
+  def inc(self, labels=(), amount=1):
+    self.values[labels] = self.values.get(labels, 0) + amount
+
+  def samples(self):
+    for labels, value in sorted(self.values.items()):
+      yield self.name + _format_labels(self.labels, labels), value
+
+
+class Histogram(object):
+  type = 'histogram'
+
+  def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.buckets = buckets
+    self.values = {}
+
+  def observe(self, value, labels=()):
+    state = self.values.get(labels)
+    if state is None:
+      # per-bucket counts, sum, count
+      state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+    state[0][bisect_left(self.buckets, value)] += 1
+    state[1] += value
+    state[2] += 1
+
+  def samples(self):
+    for labels, (counts, total, count) in sorted(self.values.items()):
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets, counts):
+        cumulative += bucket_count
+        yield self.name + '_bucket' + _format_labels(self.labels, labels, ('le', bound)), cumulative
+      yield self.name + '_bucket' + _format_labels(self.labels, labels, ('le', '+Inf')), count
+      yield self.name + '_sum' + _format_labels(self.labels, labels), total
+      yield self.name + '_count' + _format_labels(self.labels, labels), count
+
+
+class Gauge(object):
+  type = 'gauge'
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.callbacks = {}
+
+  def set_function(self, fn, labels=()):
+    self.callbacks[labels] = fn
+
+  def samples(self):
+    for labels, fn in sorted(self.callbacks.items()):
+      yield self.name + _format_labels(self.labels, labels), fn()
+
+
+class Metrics(object):
+  def __init__(self, prefix='ttbot'):
+    self.metrics = []
+    self.api_request_duration = self.add(Histogram(
+      prefix + '_api_request_duration_seconds', 'Telegram API request latency', ('bot', 'method')))
+    self.api_responses = self.add(Counter(
+      prefix + '_api_responses_total', 'Telegram API responses by status or error code', ('bot', 'method', 'status')))
+    self.handler_duration = self.add(Histogram(
+      prefix + '_handler_duration_seconds', 'Update handler execution time', ('bot', 'handler')))
+    self.handler_errors = self.add(Counter(
+      prefix + '_handler_errors_total', 'Update handlers that failed', ('bot', 'handler')))
+    self.update_batch_size = self.add(Histogram(
+      prefix + '_update_batch_size', 'Updates returned by getUpdates', ('bot',), buckets=BATCH_SIZE_BUCKETS))
+    self.updates_in_flight = self.add(Gauge(
+      prefix + '_updates_in_flight', 'Pipelined updates not yet committed', ('bot',)))
+    self.chat_queue_depth = self.add(Gauge(
+      prefix + '_chat_queue_depth', 'Messages waiting or running in per-chat queues', ('bot',)))
+    self.rate_limiter_queue_depth = self.add(Gauge(
+      prefix + '_rate_limiter_queue_depth', 'Requests waiting for the rate limiter', ('bot',)))
+
+  def add(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  def render(self):
+    lines = []
+    for metric in self.metrics:
+      lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+      lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+      for name, value in metric.samples():
+        lines.append('{0} {1}'.format(name, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(Resource):
+  isLeaf = True
+
+  def __init__(self, metrics):
+    Resource.__init__(self)
+    self.metrics = metrics
+
+  def render_GET(self, request):
+    request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+    return self.metrics.render().encode('utf-8')
@@ -0,0 +1,115 @@
+import functools
+import multiprocessing
+import pickle
+import traceback
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import blockingCallFromThread, deferToThread, deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+def _wraps(fn):
+  # keeps the handler name for logs and metrics, callable objects may not have one
+  return functools.wraps(fn, [name for name in functools.WRAPPER_ASSIGNMENTS if hasattr(fn, name)])
+
+
+class BotProxy(object):
+  # handed to handlers running in a thread: bot methods run on the reactor thread and block until
+  # their Deferred fires, so bot.send_message(...) returns the sent Message or raises ApiException
+  def __init__(self, bot, reactor=reactor):
+    self._bot = bot
+    self._reactor = reactor
+
+  def __getattr__(self, name):
+    value = getattr(self._bot, name)
+    if not callable(value):
+      return value
+
+    def call(*args, **kwargs):
+      return blockingCallFromThread(self._reactor, value, *args, **kwargs)
+
+    return call
+
+
+class ThreadOffload(object):
+  def __init__(self, max_threads=10, name='ttbot-handlers', reactor=reactor):
+    self.reactor = reactor
+    self.pool = ThreadPool(minthreads=0, maxthreads=max_threads, name=name)
+    self.pool.start()
+    self._shutdown = reactor.addSystemEventTrigger('during', 'shutdown', self.close)
+
+  def run(self, fn, *args, **kwargs):
+    return deferToThreadPool(self.reactor, self.pool, fn, *args, **kwargs)
+
+  def handler(self, fn):
+    # handlers are called as fn(update, bot, ...), the bot is swapped for a thread-safe proxy
+    @_wraps(fn)
+    def run_in_thread(update, bot, *args, **kwargs):
+      return self.run(fn, update, BotProxy(bot, self.reactor), *args, **kwargs)
+
+    return run_in_thread
+
+  def close(self):
+    if self._shutdown is not None:
+      self.reactor.removeSystemEventTrigger(self._shutdown)
+      self._shutdown = None
+      self.pool.stop()
+
+
+def _call_safely(fn, args, kwargs):
+  # multiprocessing in Python 2 has no error callback, so failures travel back as results
+  try:
+    result = fn(*args, **kwargs)
+    # an unpicklable result would be lost on the way back and the Deferred would never fire
+    pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    return True, result
+  except Exception as e:
+    try:
+      pickle.dumps(e, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+      e = RuntimeError(repr(e))
+    return False, (e, traceback.format_exc())
+
+
+class ProcessError(Exception):
+  def __init__(self, error, remote_traceback):
+    super(ProcessError, self).__init__("{0}\n{1}".format(error, remote_traceback))
+    self.error = error
+    self.remote_traceback = remote_traceback
+
+
+class ProcessOffload(object):
+  # fn, its arguments and its result are pickled, so fn has to be a module level function; create the
+  # pool before the reactor starts threads
+  def __init__(self, processes=None, reactor=reactor):
+    self.reactor = reactor
+    self.pool = multiprocessing.Pool(processes)
+
+  def run(self, fn, *args, **kwargs):
+    d = Deferred()
+
+    def _done(result):
+      ok, value = result
+      if ok:
+        d.callback(value)
+      else:
+        d.errback(ProcessError(*value))
+
+    self.pool.apply_async(_call_safely, (fn, args, kwargs),
+                          callback=lambda result: self.reactor.callFromThread(_done, result))
+    return d
+
+  def handler(self, fn):
+    # the bot can't cross the process boundary, so fn(update) only gets the update. The bot ignores
+    # what handlers return, so fn's result is dropped; when the work needs an answer, call run() from a
+    # reactor-side handler and reply with its result
+    @_wraps(fn)
+    def run_in_process(update, *args, **kwargs):
+      return self.run(fn, update)
+
+    return run_in_process
+
+  def close(self):
+    self.pool.close()
+    return deferToThread(self.pool.join)
@@ -0,0 +1,26 @@
+class AdaptivePoll(object):
+  def __init__(self, limit=100, timeout=10, min_limit=10, max_limit=100, min_timeout=1, max_timeout=50,
+               target_processing_time=5):
+    self.limit = limit
+    self.timeout = timeout
+    self.min_limit = min_limit
+    self.max_limit = max_limit
+    self.min_timeout = min_timeout
+    self.max_timeout = max_timeout
+    self.target_processing_time = target_processing_time
+
+  def observe_batch(self, size):
+    if size >= self.limit:
+      # there is a backlog, fetch more per request
+      self.limit = min(self.max_limit, self.limit * 2)
+    elif size == 0:
+      # idle, hold the long poll open longer and make fewer requests
+      self.timeout = min(self.max_timeout, self.timeout * 2)
+
+  def observe_processing(self, seconds):
+    if seconds > self.target_processing_time:
+      self.limit = max(self.min_limit, self.limit // 2)
+
+  def failed(self):
+    # short polls notice quickly when the API is back or a connection hangs
+    self.timeout = self.min_timeout
@@ -0,0 +1,93 @@
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred, fail
+from twisted.logger import Logger
+
+log = Logger()
+
+
+class QueueFullError(Exception):
+  def __init__(self, chat_id, max_queue_length):
+    super(QueueFullError, self).__init__("Queue for chat {0} is full ({1} items)".format(chat_id, max_queue_length))
+    self.chat_id = chat_id
+
+
+class ChatQueues(object):
+  def __init__(self, max_concurrency=100, max_queue_length=100):
+    self.max_concurrency = max_concurrency
+    self.max_queue_length = max_queue_length
+    self.running = 0
+    self._queues = {}
+    self._ready = deque()
+    self._held = {}
+    self._dispatching = False
+
+  def __len__(self):
+    return sum(len(queue) for queue in self._queues.itervalues()) + \
+        sum(len(held) for held in self._held.itervalues())
+
+  @property
+  def chats(self):
+    return len(self._queues)
+
+  def enqueue(self, chat_id, f, *args, **kwargs):
+    queue = self._queues.get(chat_id)
+    if queue is None:
+      queue = self._queues[chat_id] = deque()
+    elif len(queue) >= self.max_queue_length or chat_id in self._held:
+      return fail(QueueFullError(chat_id, self.max_queue_length))
+
+    d = Deferred()
+    queue.append((d, f, args, kwargs))
+    if len(queue) == 1:
+      # the chat has nothing running, so it is waiting for a free slot now
+      self._ready.append(chat_id)
+      self._run_ready()
+    return d
+
+  def put(self, chat_id, f, *args, **kwargs):
+    # like enqueue, but a job for a full chat is held back until the chat has room instead of failing,
+    # so the caller's Deferred only fires once the job has run
+    queue = self._queues.get(chat_id)
+    if queue is None or len(queue) < self.max_queue_length and chat_id not in self._held:
+      return self.enqueue(chat_id, f, *args, **kwargs)
+    held = self._held.get(chat_id)
+    if held is None:
+      log.warn("Queue for chat {chat_id} is full, holding new jobs back", chat_id=chat_id)
+      held = self._held[chat_id] = deque()
+    d = Deferred()
+    held.append((d, f, args, kwargs))
+    return d
+
+  def _run_ready(self):
+    if self._dispatching:
+      # called from a job that finished synchronously, the outer loop picks up the rest
+      return
+    self._dispatching = True
+    try:
+      while self._ready and self.running < self.max_concurrency:
+        chat_id = self._ready.popleft()
+        d, f, args, kwargs = self._queues[chat_id][0]
+        self.running += 1
+        result = maybeDeferred(f, *args, **kwargs)
+        result.addBoth(self._done, chat_id)
+        result.chainDeferred(d)
+    finally:
+      self._dispatching = False
+
+  def _done(self, result, chat_id):
+    self.running -= 1
+    queue = self._queues[chat_id]
+    queue.popleft()
+    held = self._held.get(chat_id)
+    if held:
+      queue.append(held.popleft())
+      if not held:
+        del self._held[chat_id]
+    if queue:
+      self._ready.append(chat_id)
+    else:
+      # drop idle chats right away, so only chats with pending work are kept
+      del self._queues[chat_id]
+    self._run_ready()
+    return result
@@ -0,0 +1,157 @@
+from collections import deque
+
+from twisted.internet.defer import Deferred, succeed
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+RATE_LIMITED_METHODS = frozenset([
+  'sendMessage',
+  'sendAudio',
+  'sendDocument',
+  'sendPhoto',
+  'sendVoice',
+  'editMessageText',
+])
+
+
+class TokenBucket(object):
+  __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+  def __init__(self, rate, capacity, now):
+    self.rate = float(rate)
+    self.capacity = capacity
+    self.tokens = float(capacity)
+    self.updated = now
+
+  def delay(self, now):
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    if self.tokens >= 1:
+      return 0
+    return (1 - self.tokens) / self.rate
+
+  def consume(self):
+    self.tokens -= 1
+
+  def is_full(self, now):
+    return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+def is_group_chat(chat_id):
+  try:
+    return int(chat_id) < 0
+  except (TypeError, ValueError):
+    # '@channelusername'
+    return True
+
+
+class RateLimiter(object):
+  def __init__(self, clock=None,
+               global_rate=30, global_burst=30,
+               private_chat_rate=1, private_chat_burst=1,
+               group_chat_rate=20 / 60.0, group_chat_burst=1,
+               max_chat_buckets=10000):
+    if clock is None:
+      from twisted.internet import reactor as clock
+    self.clock = clock
+    self.private_chat_rate = private_chat_rate
+    self.private_chat_burst = private_chat_burst
+    self.group_chat_rate = group_chat_rate
+    self.group_chat_burst = group_chat_burst
+    self.max_chat_buckets = max_chat_buckets
+    self._global = TokenBucket(global_rate, global_burst, clock.seconds())
+    self._chats = {}
+    self._queues = (deque(), deque(), deque())
+    self._delayed_call = None
+
+  def queue_depth(self, priority=None):
+    if priority is None:
+      return sum(len(queue) for queue in self._queues)
+    return len(self._queues[priority])
+
+  def acquire(self, chat_id=None, priority=PRIORITY_NORMAL):
+    if chat_id is not None:
+      # some methods pass the chat id as an int, others as a str, both are the same chat
+      chat_id = str(chat_id)
+    if not self.queue_depth() and self._try_consume(chat_id, self.clock.seconds()) == 0:
+      return succeed(None)
+    d = Deferred()
+    self._queues[priority].append((chat_id, d))
+    self._schedule(0)
+    return d
+
+  def _chat_bucket(self, chat_id, now):
+    bucket = self._chats.get(chat_id)
+    if bucket is None:
+      if len(self._chats) >= self.max_chat_buckets:
+        # full buckets carry no state, a new one would be identical
+        for key in [key for key, b in self._chats.iteritems() if b.is_full(now)]:
+          del self._chats[key]
+      if is_group_chat(chat_id):
+        bucket = TokenBucket(self.group_chat_rate, self.group_chat_burst, now)
+      else:
+        bucket = TokenBucket(self.private_chat_rate, self.private_chat_burst, now)
+      self._chats[chat_id] = bucket
+    return bucket
+
+  def _try_consume(self, chat_id, now):
+    delay = self._global.delay(now)
+    if delay > 0:
+      return delay
+    bucket = None
+    if chat_id is not None:
+      bucket = self._chat_bucket(chat_id, now)
+      delay = bucket.delay(now)
+      if delay > 0:
+        return delay
+    self._global.consume()
+    if bucket is not None:
+      bucket.consume()
+    return 0
+
+  def _schedule(self, delay):
+    if self._delayed_call is not None:
+      if self._delayed_call.getTime() <= self.clock.seconds() + delay:
+        return
+      self._delayed_call.cancel()
+    self._delayed_call = self.clock.callLater(delay, self._pump)
+
+  def _pump(self):
+    self._delayed_call = None
+    now = self.clock.seconds()
+    ready = []
+    wait = None
+
+    for queue in self._queues:
+      blocked = set()
+      i = 0
+      while i < len(queue):
+        chat_id, d = queue[i]
+        if d.called:
+          # cancelled while waiting
+          del queue[i]
+          continue
+        if chat_id in blocked:
+          i += 1
+          continue
+        delay = self._try_consume(chat_id, now)
+        if delay == 0:
+          del queue[i]
+          ready.append(d)
+          continue
+        if self._global.delay(now) > 0:
+          wait = delay if wait is None else min(wait, delay)
+          break
+        blocked.add(chat_id)
+        wait = delay if wait is None else min(wait, delay)
+        i += 1
+      else:
+        continue
+      break
+
+    if wait is not None:
+      self._schedule(wait)
+    for d in ready:
+      d.callback(None)
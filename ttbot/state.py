@@ -0,0 +1,123 @@
+import heapq
+import shelve
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+EVICTED_CAPACITY = 'capacity'
+EVICTED_EXPIRED = 'expired'
+
+
+class MemoryStateStore(object):
+  def __init__(self, maxsize=10000, ttl=None, on_evict=None, clock=None):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.on_evict = on_evict
+    self.clock = clock or reactor
+    self.evictions = 0
+    self.expirations = 0
+    # key -> expiry time in least recently used order, the values live in _values
+    self._order = OrderedDict()
+    self._expiry = []
+    self._values = {}
+
+  def _get_value(self, key):
+    return self._values[key]
+
+  def _set_value(self, key, value, expires):
+    self._values[key] = value
+
+  def _pop_value(self, key):
+    return self._values.pop(key)
+
+  def __len__(self):
+    self._expire()
+    return len(self._order)
+
+  def __contains__(self, key):
+    self._expire()
+    return key in self._order
+
+  def __getitem__(self, key):
+    self._expire()
+    expires = self._order.pop(key)
+    self._order[key] = expires
+    return self._get_value(key)
+
+  def __setitem__(self, key, value):
+    self.set(key, value)
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def set(self, key, value, ttl=None):
+    self._expire()
+    ttl = ttl if ttl is not None else self.ttl
+    expires = self.clock.seconds() + ttl if ttl else None
+    # a failed write (an unpicklable value on disk) leaves the store as it was
+    self._set_value(key, value, expires)
+    self._order.pop(key, None)
+    self._order[key] = expires
+    if expires is not None:
+      heapq.heappush(self._expiry, (expires, key))
+    while self.maxsize is not None and len(self._order) > self.maxsize:
+      evicted_key, _ = self._order.popitem(last=False)
+      self.evictions += 1
+      self._evicted(evicted_key, self._pop_value(evicted_key), EVICTED_CAPACITY)
+
+  def pop(self, key, default=None):
+    self._expire()
+    if key not in self._order:
+      return default
+    del self._order[key]
+    return self._pop_value(key)
+
+  def _expire(self):
+    if not self._expiry:
+      return
+    now = self.clock.seconds()
+    while self._expiry and self._expiry[0][0] <= now:
+      expires, key = heapq.heappop(self._expiry)
+      # entries that were replaced or removed leave stale heap items behind
+      if key in self._order and self._order[key] == expires:
+        del self._order[key]
+        self.expirations += 1
+        self._evicted(key, self._pop_value(key), EVICTED_EXPIRED)
+    if len(self._expiry) > 2 * len(self._order) + 64:
+      self._expiry = [(expires, key) for key, expires in self._order.iteritems() if expires is not None]
+      heapq.heapify(self._expiry)
+
+  def _evicted(self, key, value, reason):
+    if self.on_evict is not None:
+      self.on_evict(key, value, reason)
+
+  def close(self):
+    pass
+
+
+class ShelveStateStore(MemoryStateStore):
+  # values have to be picklable, so register module level functions rather than lambdas or closures
+  def __init__(self, path, maxsize=None, ttl=None, on_evict=None, clock=None):
+    super(ShelveStateStore, self).__init__(maxsize, ttl, on_evict, clock)
+    # protocol 0, the Python 2 default, can't pickle the slotted ttbot types
+    self._values = shelve.open(path, protocol=2)
+    for key, _, expires in self._values.itervalues():
+      self._order[key] = expires
+      if expires is not None:
+        self._expiry.append((expires, key))
+    heapq.heapify(self._expiry)
+
+  def _get_value(self, key):
+    return self._values[repr(key)][1]
+
+  def _set_value(self, key, value, expires):
+    self._values[repr(key)] = (key, value, expires)
+
+  def _pop_value(self, key):
+    return self._values.pop(repr(key))[1]
+
+  def close(self):
+    self._values.close()
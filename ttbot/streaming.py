@@ -0,0 +1,162 @@
+import os
+
+from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IConsumer
+from twisted.internet.protocol import Protocol
+from twisted.web.client import FileBodyProducer, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+from zope.interface import implementer
+
+# the Bot API does not serve files larger than this
+MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024
+
+
+class FileTooLargeError(Exception):
+  def __init__(self, size, max_size):
+    super(FileTooLargeError, self).__init__("File is larger than {0} bytes ({1})".format(max_size, size))
+    self.size = size
+    self.max_size = max_size
+
+
+@implementer(IConsumer)
+class FileConsumer(object):
+  def __init__(self, fileobj):
+    self.fileobj = fileobj
+    self.producer = None
+
+  def registerProducer(self, producer, streaming):
+    self.producer = producer
+
+  def unregisterProducer(self):
+    self.producer = None
+
+  def write(self, data):
+    self.fileobj.write(data)
+
+
+class _BodyStreamer(Protocol):
+  def __init__(self, consumer, finished, max_size):
+    self.consumer = consumer
+    self.finished = finished
+    self.max_size = max_size
+    self.received = 0
+    self.error = None
+
+  def connectionMade(self):
+    # the consumer pauses the response transport when it can't keep up
+    self.consumer.registerProducer(self.transport, True)
+
+  def dataReceived(self, data):
+    if self.error is not None:
+      return
+    self.received += len(data)
+    if self.max_size and self.received > self.max_size:
+      self.error = FileTooLargeError(self.received, self.max_size)
+      self.transport.stopProducing()
+      return
+    self.consumer.write(data)
+
+  def connectionLost(self, reason):
+    self.consumer.unregisterProducer()
+    if self.error is not None:
+      self.finished.errback(self.error)
+    elif reason.check(ResponseDone, PotentialDataLoss):
+      self.finished.callback(self.received)
+    else:
+      self.finished.errback(reason)
+
+
+def stream_body(response, consumer, max_size=None):
+  finished = Deferred()
+  response.deliverBody(_BodyStreamer(consumer, finished, max_size))
+  return finished
+
+
+def stream_body_to_path(response, path, max_size=None):
+  partial_path = path + '.part'
+  fileobj = open(partial_path, 'wb')
+
+  def _done(size):
+    fileobj.close()
+    os.rename(partial_path, path)
+    return size
+
+  def _failed(failure):
+    fileobj.close()
+    os.remove(partial_path)
+    return failure
+
+  return stream_body(response, FileConsumer(fileobj), max_size).addCallbacks(_done, _failed)
+
+
+class InputFile(object):
+  def __init__(self, source, filename=None, content_type=None):
+    self.source = source
+    self.filename = filename
+    self.content_type = content_type
+    self._fileobj = None
+
+  def open(self, progress=None):
+    filename = self.filename
+    if IBodyProducer.providedBy(self.source):
+      producer = self.source
+    elif isinstance(self.source, basestring):
+      self._fileobj = open(self.source, 'rb')
+      producer = FileBodyProducer(self._fileobj)
+      filename = filename or os.path.basename(self.source)
+    else:
+      producer = FileBodyProducer(self.source)
+      if not filename and isinstance(getattr(self.source, 'name', None), basestring):
+        filename = os.path.basename(self.source.name)
+
+    if producer.length == UNKNOWN_LENGTH:
+      self.close()
+      raise ValueError("Upload length must be known")
+    if progress is not None:
+      producer = ProgressProducer(producer, progress)
+    return filename or 'file', self.content_type, producer
+
+  def close(self):
+    if self._fileobj is not None:
+      self._fileobj.close()
+      self._fileobj = None
+
+
+@implementer(IBodyProducer)
+class ProgressProducer(object):
+  def __init__(self, producer, progress):
+    self.producer = producer
+    self.progress = progress
+    self.length = producer.length
+    self.sent = 0
+
+  def startProducing(self, consumer):
+    return self.producer.startProducing(_ProgressConsumer(consumer, self))
+
+  def pauseProducing(self):
+    self.producer.pauseProducing()
+
+  def resumeProducing(self):
+    self.producer.resumeProducing()
+
+  def stopProducing(self):
+    self.producer.stopProducing()
+
+
+@implementer(IConsumer)
+class _ProgressConsumer(object):
+  def __init__(self, consumer, producer):
+    self.consumer = consumer
+    self.producer = producer
+
+  def registerProducer(self, producer, streaming):
+    self.consumer.registerProducer(producer, streaming)
+
+  def unregisterProducer(self):
+    self.consumer.unregisterProducer()
+
+  def write(self, data):
+    self.consumer.write(data)
+    self.producer.sent += len(data)
+    self.producer.progress(self.producer.sent, self.producer.length)
@@ -1,15 +1,19 @@
-import json
+from ttbot import codec
 
 
 class JsonSerializable(object):
+  __slots__ = ()
+
   def to_json(self, ensure_ascii=False):
-    return json.dumps(self.to_json_dict(), ensure_ascii=ensure_ascii)
+    return codec.dumps(self.to_json_dict(), ensure_ascii=ensure_ascii)
 
   def to_json_dict(self):
     raise NotImplementedError
 
 
 class JsonDeserializable(object):
+  __slots__ = ()
+
   @classmethod
   def de_json(cls, json_string):
     raise NotImplementedError
@@ -19,12 +23,14 @@ class JsonDeserializable(object):
     if type(json_obj) == dict:
       return json_obj
     elif type(json_obj) in [str, unicode]:
-      return json.loads(json_obj)
+      return codec.loads(json_obj)
     else:
       raise ValueError("Invalid json type: %s" % type(json_obj))
 
 
 class File(JsonDeserializable):
+  __slots__ = ('id', 'size', 'path')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -37,6 +43,10 @@ class File(JsonDeserializable):
 
 
 class User(JsonDeserializable):
+  __slots__ = ('id', 'first_name', 'username', 'last_name', 'language_code')
+
+  type = 'private'
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -52,11 +62,16 @@ class User(JsonDeserializable):
     self.first_name = first_name
     self.username = username
     self.last_name = last_name
-    self.type = 'private'
     self.language_code = language_code
 
 
 class Message(JsonDeserializable):
+  # optional fields stay unset rather than None, so hasattr(message, 'reply_to_message') keeps working
+  __slots__ = ('chat', 'date', 'from_user', 'message_id', 'content_type', 'bot_name', 'update_id',
+               'forward_from', 'forward_date', 'reply_to_message', 'text', 'audio', 'voice', 'document', 'photo',
+               'sticker', 'video', 'location', 'contact', 'new_chat_participant', 'left_chat_participant',
+               'new_chat_title', 'new_chat_photo', 'delete_chat_photo', 'group_chat_created', 'caption')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -99,7 +114,7 @@ class Message(JsonDeserializable):
       opts['location'] = Location.de_json(obj['location'])
       content_type = 'location'
     if 'contact' in obj:
-      opts['contact'] = Contact.de_json(json.dumps(obj['contact']))
+      opts['contact'] = Contact.de_json(obj['contact'])
       content_type = 'contact'
     if 'new_chat_participant' in obj:
       opts['new_chat_participant'] = User.de_json(obj['new_chat_participant'])
@@ -151,7 +166,51 @@ class Message(JsonDeserializable):
     return "Message #%d" % self.message_id
 
 
+def _normalize_text(text):
+  return " ".join(text.split())
+
+
+class LazyMessage(Message):
+  # keeps the raw dict and builds sub-objects on first access, the attribute API is the same as Message
+  __slots__ = ('_obj',)
+
+  content_types = ('text', 'audio', 'voice', 'document', 'photo', 'sticker', 'video', 'location', 'contact',
+                   'new_chat_participant', 'left_chat_participant', 'new_chat_title', 'new_chat_photo',
+                   'delete_chat_photo', 'group_chat_created')
+
+  @classmethod
+  def de_json(cls, json_string):
+    return cls(cls.check_json(json_string))
+
+  def __init__(self, obj):
+    self._obj = obj
+    self.message_id = obj['message_id']
+    self.date = obj['date']
+    self.content_type = None
+    for content_type in self.content_types:
+      if content_type in obj:
+        self.content_type = content_type
+    self.bot_name = None
+
+  def __getattr__(self, name):
+    field = _LAZY_MESSAGE_FIELDS.get(name)
+    if field is None:
+      raise AttributeError(name)
+    key, parser, always_set = field
+    obj = self._obj
+    if key in obj:
+      value = parser(obj[key]) if parser is not None else obj[key]
+    elif always_set:
+      value = None
+    else:
+      raise AttributeError(name)
+    setattr(self, name, value)
+    return value
+
+
 class PhotoSize(JsonDeserializable):
+  __slots__ = ('file_size', 'height', 'width', 'file_id')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -169,6 +228,8 @@ class PhotoSize(JsonDeserializable):
 
 
 class Audio(JsonDeserializable):
+  __slots__ = ('file_id', 'duration', 'performer', 'title', 'mime_type', 'file_size')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -190,6 +251,8 @@ class Audio(JsonDeserializable):
 
 
 class Voice(JsonDeserializable):
+  __slots__ = ('file_id', 'duration', 'mime_type', 'file_size')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -211,6 +274,8 @@ class Voice(JsonDeserializable):
 
 
 class InlineQuery(JsonDeserializable):
+  __slots__ = ('query_id', 'from_user', 'query', 'offset', 'update_id')
+
   def __init__(self, query_id, from_user, query, offset):
     self.query_id = query_id
     self.from_user = from_user
@@ -228,6 +293,8 @@ class InlineQuery(JsonDeserializable):
 
 
 class ChosenInlineResult(JsonDeserializable):
+  __slots__ = ('result_id', 'from_user', 'query', 'update_id')
+
   def __init__(self, result_id, from_user, query):
     self.result_id = result_id
     self.from_user = from_user
@@ -243,6 +310,8 @@ class ChosenInlineResult(JsonDeserializable):
 
 
 class CallbackQuery(JsonDeserializable):
+  __slots__ = ('query_id', 'from_user', 'data', 'message', 'inline_message_id', 'update_id')
+
   def __init__(self, query_id, from_user, data, message, inline_message_id):
     self.query_id = query_id
     self.from_user = from_user
@@ -264,6 +333,8 @@ class CallbackQuery(JsonDeserializable):
 
 
 class Document(JsonDeserializable):
+  __slots__ = ('file_id', 'thumb', 'file_name', 'mime_type', 'file_size')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -292,6 +363,8 @@ class Document(JsonDeserializable):
 
 
 class Sticker(JsonDeserializable):
+  __slots__ = ('file_id', 'width', 'height', 'thumb', 'file_size')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -315,6 +388,8 @@ class Sticker(JsonDeserializable):
 
 
 class Video(JsonDeserializable):
+  __slots__ = ('file_id', 'width', 'height', 'duration', 'thumb', 'mime_type', 'file_size')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -344,6 +419,8 @@ class Video(JsonDeserializable):
 
 
 class Contact(JsonDeserializable):
+  __slots__ = ('phone_number', 'first_name', 'last_name', 'user_id')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -365,6 +442,8 @@ class Contact(JsonDeserializable):
 
 
 class Location(JsonDeserializable):
+  __slots__ = ('longitude', 'latitude')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -378,6 +457,8 @@ class Location(JsonDeserializable):
 
 
 class UserProfilePhotos(JsonDeserializable):
+  __slots__ = ('total_count', 'photos')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -391,6 +472,8 @@ class UserProfilePhotos(JsonDeserializable):
 
 
 class GroupChat(JsonDeserializable):
+  __slots__ = ('id', 'title', 'type')
+
   @classmethod
   def de_json(cls, json_string):
     obj = cls.check_json(json_string)
@@ -406,6 +489,8 @@ class GroupChat(JsonDeserializable):
 
 
 class InlineKeyboardMarkup(JsonSerializable):
+  __slots__ = ('buttons',)
+
   def to_json_dict(self):
     return {'inline_keyboard': [[button.to_json_dict() for button in row] for row in self.buttons]}
 
@@ -414,8 +499,10 @@ class InlineKeyboardMarkup(JsonSerializable):
 
 
 class InlineKeyboardButton(JsonSerializable):
+  __slots__ = ('text', 'url', 'callback_data', 'switch_inline_query')
+
   def to_json_dict(self):
-    return {k: v for k, v in self.__dict__.items() if v is not None}
+    return {k: getattr(self, k) for k in self.__slots__ if getattr(self, k) is not None}
 
   def __init__(self, text, url=None, callback_data=None, switch_inline_query=None):
     super(InlineKeyboardButton, self).__init__()
@@ -425,6 +512,34 @@ class InlineKeyboardButton(JsonSerializable):
     self.switch_inline_query = switch_inline_query
 
 
-class ChannelPost:
+class ChannelPost(object):
+  __slots__ = ('message', 'update_id')
+
   def __init__(self, message):
-    self.message = message
\ No newline at end of file
+    self.message = message
+
+
+# attribute -> (json key, parser, whether Message always sets the attribute)
+_LAZY_MESSAGE_FIELDS = {
+  'chat': ('chat', Message.parse_chat, True),
+  'from_user': ('from', User.de_json, True),
+  'forward_from': ('forward_from', User.de_json, False),
+  'forward_date': ('forward_date', None, False),
+  'reply_to_message': ('reply_to_message', LazyMessage.de_json, False),
+  'text': ('text', _normalize_text, False),
+  'audio': ('audio', Audio.de_json, False),
+  'voice': ('voice', Audio.de_json, False),
+  'document': ('document', Document.de_json, False),
+  'photo': ('photo', Message.parse_photo, False),
+  'sticker': ('sticker', Sticker.de_json, False),
+  'video': ('video', Video.de_json, False),
+  'location': ('location', Location.de_json, False),
+  'contact': ('contact', Contact.de_json, False),
+  'new_chat_participant': ('new_chat_participant', User.de_json, False),
+  'left_chat_participant': ('left_chat_participant', User.de_json, False),
+  'new_chat_title': ('new_chat_title', None, False),
+  'new_chat_photo': ('new_chat_photo', None, False),
+  'delete_chat_photo': ('delete_chat_photo', None, False),
+  'group_chat_created': ('group_chat_created', None, False),
+  'caption': ('caption', None, False),
+}
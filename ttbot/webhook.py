@@ -0,0 +1,77 @@
+import hmac
+
+from twisted.internet.defer import maybeDeferred
+from twisted.logger import Logger
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+from ttbot import codec
+
+log = Logger()
+
+SECRET_TOKEN_HEADER = b'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookResource(Resource):
+  isLeaf = True
+
+  def __init__(self, bot, secret_token=None, max_connections=40):
+    Resource.__init__(self)
+    self.bot = bot
+    if isinstance(secret_token, unicode):
+      secret_token = secret_token.encode('utf-8')
+    self.secret_token = secret_token
+    self.max_connections = max_connections
+    self.active_requests = 0
+
+  def render_POST(self, request):
+    if self.secret_token is not None \
+        and not hmac.compare_digest(request.getHeader(SECRET_TOKEN_HEADER) or b'', self.secret_token):
+      request.setResponseCode(403)
+      return b''
+
+    if self.max_connections and self.active_requests >= self.max_connections:
+      # Telegram redelivers the update later
+      request.setResponseCode(503)
+      return b''
+
+    try:
+      update = codec.loads(request.content.read())
+      update_id = update['update_id']
+    except:
+      log.failure("Invalid webhook payload")
+      request.setResponseCode(400)
+      return b''
+
+    self.active_requests += 1
+    # a malformed update can raise before process_webhook_update returns a Deferred
+    d = maybeDeferred(self.bot.process_webhook_update, update)
+
+    def _failed(failure):
+      log.failure("Couldn't process webhook update {update_id}", failure, update_id=update_id)
+
+    def _finish(_):
+      try:
+        if not finished.called:
+          request.finish()
+      finally:
+        self.active_requests -= 1
+
+    finished = request.notifyFinish()
+    finished.addErrback(lambda _: None)
+    d.addErrback(_failed)
+    d.addBoth(_finish)
+    return NOT_DONE_YET
+
+
+def webhook_site(bot, path, secret_token=None, max_connections=40):
+  root = Resource()
+  resource = WebhookResource(bot, secret_token=secret_token, max_connections=max_connections)
+  segments = [segment.encode('utf-8') for segment in path.strip('/').split('/')]
+  parent = root
+  for segment in segments[:-1]:
+    child = Resource()
+    parent.putChild(segment, child)
+    parent = child
+  parent.putChild(segments[-1], resource)
+  return Site(root)
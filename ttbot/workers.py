@@ -0,0 +1,235 @@
+import importlib
+import os
+import sys
+from collections import OrderedDict, deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, maybeDeferred, succeed
+from twisted.internet.protocol import ProcessProtocol
+from twisted.logger import Logger
+from twisted.protocols.basic import LineReceiver
+
+from ttbot import codec
+
+log = Logger()
+
+MAX_LINE_LENGTH = 16 * 1024 * 1024
+
+# workers write acknowledgements here, so handler output on stdout can't corrupt them
+ACK_FD = 3
+
+
+def update_chat_id(update):
+  for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+    if key in update:
+      return update[key]['chat']['id']
+  if 'callback_query' in update:
+    callback_query = update['callback_query']
+    if 'message' in callback_query:
+      return callback_query['message']['chat']['id']
+    return callback_query['from']['id']
+  for key in ('inline_query', 'chosen_inline_result'):
+    if key in update:
+      return update[key]['from']['id']
+  return update['update_id']
+
+
+def _cpu_count():
+  try:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+
+def _encode(message):
+  return codec.dumps(message).encode('utf-8') + b'\n'
+
+
+class _Worker(object):
+  def __init__(self, index):
+    self.index = index
+    self.protocol = None
+    self.in_flight = OrderedDict()
+    self.backlog = deque()
+    # update_id -> Deferreds of redeliveries, for every update dispatched and not yet acknowledged
+    self.duplicates = {}
+
+
+class _WorkerProcessProtocol(ProcessProtocol):
+  def __init__(self, pool, worker):
+    self.pool = pool
+    self.worker = worker
+    self._buffer = b''
+
+  def connectionMade(self):
+    self.pool._worker_started(self.worker, self)
+
+  def send(self, update_id, update):
+    self.transport.writeToChild(0, _encode({'id': update_id, 'update': update}))
+
+  def childDataReceived(self, fd, data):
+    if fd != ACK_FD:
+      return
+    lines = (self._buffer + data).split(b'\n')
+    self._buffer = lines.pop()
+    for line in lines:
+      try:
+        update_id = codec.loads(line)['ack']
+      except (ValueError, KeyError, TypeError):
+        log.warn("Ignoring unexpected output from worker {index}: {line!r}", index=self.worker.index, line=line)
+        continue
+      self.pool._acknowledged(self.worker, update_id)
+
+  def processEnded(self, reason):
+    self.pool._worker_ended(self.worker, reason)
+
+
+class WorkerPool(object):
+  def __init__(self, factory, workers=None, max_in_flight=100, max_backlog=1000, respawn_delay=1,
+               executable=sys.executable, env=None, clock=None, spawn=None):
+    # factory is a 'module:callable' path that builds the TelegramBot inside each worker
+    self.factory = factory
+    self.workers = [_Worker(index) for index in range(workers or _cpu_count())]
+    self.max_in_flight = max_in_flight
+    self.max_backlog = max_backlog
+    self.respawn_delay = respawn_delay
+    self.executable = executable
+    self.env = env if env is not None else dict(os.environ)
+    self.clock = clock or reactor
+    self.spawn = spawn or reactor.spawnProcess
+    self.running = False
+    self._stopped = []
+    self._capacity_waiters = []
+
+  def start(self):
+    self.running = True
+    for worker in self.workers:
+      self._spawn(worker)
+
+  def stop(self):
+    self.running = False
+    waiting = []
+    for worker in self.workers:
+      if worker.protocol is not None:
+        d = Deferred()
+        self._stopped.append(d)
+        waiting.append(d)
+        # the worker exits once its input is closed
+        worker.protocol.transport.closeStdin()
+    return DeferredList(waiting)
+
+  def dispatch(self, update):
+    worker = self.workers[update_chat_id(update) % len(self.workers)]
+    update_id = update['update_id']
+    d = Deferred()
+    if update_id in worker.duplicates:
+      # a webhook redelivery of an update still being handled, it finishes with the first copy
+      worker.duplicates[update_id].append(d)
+      return d
+    worker.duplicates[update_id] = []
+    worker.backlog.append((update_id, update, d))
+    self._fill(worker)
+    return d
+
+  def dispatch_updates(self, updates):
+    return DeferredList([self.dispatch(update) for update in updates])
+
+  def full(self):
+    return any(len(worker.backlog) >= self.max_backlog for worker in self.workers)
+
+  def wait_for_capacity(self):
+    # the bot polls again only once every worker's backlog is below max_backlog; a batch already
+    # polled is still accepted, so a backlog can go over by at most one batch
+    if not self.full():
+      return succeed(None)
+    d = Deferred()
+    self._capacity_waiters.append(d)
+    return d
+
+  def queue_depth(self):
+    return sum(len(worker.in_flight) + len(worker.backlog) for worker in self.workers)
+
+  def _spawn(self, worker):
+    args = [self.executable, '-m', 'ttbot.workers', self.factory]
+    self.spawn(_WorkerProcessProtocol(self, worker), self.executable, args, env=self.env,
+               childFDs={0: 'w', 1: 1, 2: 2, ACK_FD: 'r'})
+
+  def _fill(self, worker):
+    # at most max_in_flight updates sit in a worker's pipe, the rest wait here
+    while worker.protocol is not None and worker.backlog and len(worker.in_flight) < self.max_in_flight:
+      update_id, update, d = worker.backlog.popleft()
+      worker.in_flight[update_id] = (update, d)
+      worker.protocol.send(update_id, update)
+    if self._capacity_waiters and not self.full():
+      waiters, self._capacity_waiters = self._capacity_waiters, []
+      for d in waiters:
+        d.callback(None)
+
+  def _worker_started(self, worker, protocol):
+    worker.protocol = protocol
+    self._fill(worker)
+
+  def _acknowledged(self, worker, update_id):
+    entry = worker.in_flight.pop(update_id, None)
+    if entry is not None:
+      entry[1].callback(update_id)
+      for d in worker.duplicates.pop(update_id, []):
+        d.callback(update_id)
+    self._fill(worker)
+
+  def _worker_ended(self, worker, reason):
+    worker.protocol = None
+    if not self.running:
+      if self._stopped:
+        self._stopped.pop().callback(None)
+      return
+
+    log.error("Worker {index} exited ({reason}), respawning with {count} unacknowledged updates",
+              index=worker.index, reason=reason.value, count=len(worker.in_flight))
+    # updates the worker had not acknowledged go out again, ahead of anything queued after them
+    for update_id, (update, d) in reversed(worker.in_flight.items()):
+      worker.backlog.appendleft((update_id, update, d))
+    worker.in_flight.clear()
+    self.clock.callLater(self.respawn_delay, self._respawn, worker)
+
+  def _respawn(self, worker):
+    if self.running and worker.protocol is None:
+      self._spawn(worker)
+
+
+class WorkerProtocol(LineReceiver):
+  delimiter = b'\n'
+  MAX_LENGTH = MAX_LINE_LENGTH
+
+  def __init__(self, bot):
+    self.bot = bot
+
+  def lineReceived(self, line):
+    message = codec.loads(line)
+    d = maybeDeferred(self.bot.process_raw_updates, [message['update']])
+    d.addErrback(lambda failure: log.failure("Update {update_id} failed", failure, update_id=message['id']))
+    d.addCallback(lambda _: self.transport.write(_encode({'ack': message['id']})))
+
+  def connectionLost(self, reason):
+    if reactor.running:
+      reactor.stop()
+
+
+def run_worker(factory):
+  from twisted.internet import stdio
+  from twisted.logger import globalLogBeginner, textFileLogObserver
+  from ttbot.queues import ChatQueues
+
+  globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stderr)])
+  module, name = factory.split(':')
+  bot = getattr(importlib.import_module(module), name)()
+  if bot.chat_queues is None:
+    # updates for a chat arrive in order, keep handling them in order
+    bot.chat_queues = ChatQueues()
+  stdio.StandardIO(WorkerProtocol(bot), stdout=ACK_FD)
+  reactor.run()
+
+
+if __name__ == '__main__':
+  run_worker(sys.argv[1])